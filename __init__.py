@@ -1,11 +1,81 @@
-from .read_data import *
-from .sims import *
-from .gene_expression import *
-from .data_process import *
-from .chromosome import *
-try :
-    from .visualize_results import *
-except ImportError :
-    warn_message ("triplib", "Importing without visualisation tools")
-except RuntimeError :
-    warn_message ("triplib", "Importing without visualisation tools")
+"""
+The submodules of triplib are imported on first use: importing the package
+only reads this file, and accessing a name such as triplib.load_genes imports
+the submodule that defines it (here read_data). A worker process that only
+uses the loaders thus never imports scipy.optimize or matplotlib. The names
+of visualize_results need matplotlib, and raise ImportError when it is missing.
+"""
+import importlib, importlib.util
+
+# the public names of each submodule. When two submodules define the same
+# name, the last one wins, as it did with the star imports
+_exports = [
+    ('messages', ['time_string', 'error_message', 'log_message', 'warn_message']),
+    ('instrument', ['enable_tracing', 'reset_tracing', 'peak_rss', 'current_rss', 'span',
+                    'add_count', 'trace_records', 'trace_summary', 'print_trace_summary',
+                    'save_trace', 'save_chrome_trace']),
+    ('cache', ['cache_dir', 'source_key', 'path_key', 'cache_file', 'remove_stale',
+               'load_cached', 'clear_cache', 'nbytes', 'LRUCache']),
+    ('binning', ['bin_index', 'field_isin', 'in_range', 'bin_counts', 'gene_ends']),
+    ('features', ['FeatureIndex', 'select_chromosome', 'select_window']),
+    ('read_data', ['base_datadir', 'hic_datadir', 'hic_file_normalized', 'hic_file_filled',
+                   'gene_file', 'activegene_file', 'colors_file', 'reporter_file',
+                   'P_powers_dir', 'chr_N_dir', 'zerolines_dir', 'DAMid_file',
+                   'chromosome_names', 'tau_values', 'hic_file', 'load_hic', 'hic_cache',
+                   'set_hic_cache_budget', 'get_hic', 'load_hic_sparse', 'read_lines',
+                   'parse_table', 'table_version', 'load_table', 'gene_dtype', 'reporter_formats',
+                   'load_genes', 'load_active_genes', 'load_colors', 'load_reporters',
+                   'load_expr_binned', 'load_P_powers', 'A_tau_file', 'load_A_tau',
+                   'transition_sampler_file', 'chromosome_N', 'chromosome_zerorows',
+                   'load_DAMid', 'load_optimize_results']),
+    ('sims', ['jump_to', 'get_rng', 'jump_many', 'TransitionSampler', 'matrix_hash',
+              'get_transition_sampler', 'walk_many', 'do_the_search', 'max_walkers',
+              'min_walker_steps', 'get_equilibrium_distribution', 'stationary_distributions',
+              'stationary_distribution', 'stationary_sweep', 'get_life_and_death',
+              'propagate_dirac_comb', 'weigh_with_exponential', 'exponential_nsteps',
+              'propagate_exponential', 'exponential_matrix_sum', 'propagate_dirac_comb_k',
+              'DiffusionObjective', 'ContactsObjective', 'obj_diffusion', 'cons', 'softmax',
+              'optimize_simplex', 'optimize_start', 'optimize_start_diffusion',
+              'obj_contacts', 'optimize_start_contacts', 'get_xstart', 'optimize_model']),
+    ('gene_expression', ['site_idx', 'gene_expression_probability_matrix', 'always_fire',
+                         'fire_if_active', 'linear_fire']),
+    ('data_process', ['ModelScorer', 'model_r2', 'ps', 'ps_kernel', 'fill_p_with_ps',
+                      'power_law_matrix', 'band_matrix', 'row_normalize_matrix', 'HopGeneMixer',
+                      'P_hop_plus_gene', 'get_promoters_and_terminators']),
+    ('toeplitz', ['ToeplitzOperator', 'power_law_operator']),
+    ('chromosome', ['Chromosome', 'load_all_chromosomes']),
+    ('multistart', ['predicted_signal', 'optimize_grid']),
+    ('pipeline', ['share_array', 'shared_array', 'worker_chromosome', 'chromosome_seed',
+                  'stage_key', 'checkpoint_file', 'run_per_chromosome', 'hop_gene_matrices',
+                  'equilibrium_stage', 'life_and_death_stage', 'model_r2_stage']),
+    ('sweep', ['sweep_cache_dir', 'model_parameters', 'wheres', 'expand_grid', 'config_key',
+               'result_file', 'load_result', 'save_result', 'start_sites', 'results_table',
+               'run_sweep']),
+    ('pyramid', ['coarse_size', 'block_starts', 'coarsen_matrix', 'coarsen_zerorows',
+                 'coarsen_expr', 'coarsen_operator', 'prolong', 'PyramidLevel', 'resolution_pyramid',
+                 'optimize_coarse_to_fine']),
+    ('visualize_results', ['max_pixels', 'new_figure', 'finish_figure', 'downsample_track',
+                           'downsample_matrix', 'stems', 'visualize_model_results',
+                           'plot_hic_matrix', 'line_plot', 'render_figures']),
+]
+
+_names = dict ([(name, module) for module, names in _exports for name in names])
+_submodules = [module for module, names in _exports] + ['benchmarks', 'precompute', 'warm_cache']
+
+# "from triplib import *" imports all the submodules, except visualize_results
+# when matplotlib is not installed
+__all__ = [name for module, names in _exports for name in names
+           if module != 'visualize_results' or importlib.util.find_spec ('matplotlib')]
+
+def __getattr__ (name) :
+    if name in _names :
+        module = importlib.import_module ('.' + _names [name], __name__)
+        value = getattr (module, name)
+        globals () [name] = value
+        return value
+    if name in _submodules :
+        return importlib.import_module ('.' + name, __name__)
+    raise AttributeError ("module %r has no attribute %r" % (__name__, name))
+
+def __dir__ () :
+    return sorted (set (globals ()) | set (_names) | set (_submodules))
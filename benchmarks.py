@@ -0,0 +1,446 @@
+"""
+Benchmarks of the simulation and optimization hot paths, on synthetic data
+that does not need the data files of the cluster. For each size N (number of
+bins) a synthetic chromosome is generated: a Hi-C-like power-law matrix with
+noise and empty rows, genes and reporters with the types of the tables of
+read_data, and the zerorows mask. Each benchmark is timed, and its peak memory
+traced, and the results are written as JSON, to be compared with the results
+of a previous version:
+
+    python -m triplib.benchmarks --sizes 1000 2000 5000 -o new.json
+    python -m triplib.benchmarks --sizes 1000 2000 5000 --compare old.json
+
+With --checks, the regression checks of checks are run instead: the
+optimizations on a chromosome with zero rows, the modules that the loaders
+import, and the names exported by the package.
+
+With --imports, the time needed to import the package and its main
+submodules in a new interpreter is measured too, and compared with the budgets
+of import_budgets.
+
+The dense N*N matrices take 8*N^2 bytes each (3.2 GB at N=20000), so choose
+the sizes according to the memory of the node. Benchmarks that are too slow
+for large N have a maximum size and are skipped beyond it.
+"""
+import numpy as np
+import os, time, json, sys, ast, platform, argparse, tracemalloc, subprocess, importlib
+from .read_data import gene_dtype, reporter_formats, load_expr_binned
+from .messages import log_message, warn_message
+from .data_process import power_law_matrix, row_normalize_matrix, P_hop_plus_gene
+from .gene_expression import gene_expression_probability_matrix, always_fire
+from .sims import do_the_search, get_equilibrium_distribution, propagate_dirac_comb, \
+    weigh_with_exponential, obj_diffusion, optimize_model, exponential_matrix_sum, \
+    optimize_start_diffusion, optimize_start_contacts
+from .pyramid import resolution_pyramid, optimize_coarse_to_fine
+
+reporter_names = ['barcode','chr','strand','pos','nexp','prom','rep']
+promoter_classes = ['pI','pII','pIII','pIV','p0']
+
+default_sizes = [1000, 2000, 5000, 10000, 20000]
+
+# synthetic data
+
+def synthetic_zerorows (N, fraction=0.02, seed=None) :
+    """
+    Returns a zerorows mask with a fraction of the N bins set
+    """
+    rng = np.random.RandomState (seed)
+    z = np.zeros (N, dtype=bool)
+    z [rng.choice (N, int (fraction*N), replace=False)] = True
+    return z
+
+def synthetic_hic (N, alpha=1.0, noise=0.2, zerorows=None, seed=None) :
+    """
+    Returns a symmetric N*N Hi-C-like matrix: the power-law matrix with
+    exponent alpha, with log-normal noise, and with the rows and columns of
+    zerorows set to zero
+    """
+    rng = np.random.RandomState (seed)
+    H = power_law_matrix (N, alpha)
+    E = rng.lognormal (0., noise, size=(N,N))
+    H *= E
+    H += H.T
+    del E
+    if zerorows is not None :
+        H [zerorows] = 0.
+        H [:,zerorows] = 0.
+    return H
+
+def synthetic_genes (N, ngenes=None, chromosome='2L', hic_res=2000, seed=None) :
+    """
+    Returns ngenes genes (default: one every 5 bins) on a chromosome of N bins,
+    with the type of read_data.load_genes
+    """
+    rng = np.random.RandomState (seed)
+    if ngenes is None :
+        ngenes = N//5
+    L = N*hic_res
+    genes = np.zeros (ngenes, dtype=gene_dtype)
+    # keep the genes and their promoters within the chromosome
+    length = rng.randint (500, 20000, ngenes)
+    start = rng.randint (1000, L-21000, ngenes)
+    genes ['chr'] = chromosome
+    genes ['start'] = start
+    genes ['end'] = start+length
+    genes ['strand'] = rng.choice (['+','-'], ngenes)
+    genes ['expr'] = rng.randn (ngenes)
+    genes ['color'] = rng.choice (['BLACK','BLUE','GREEN','RED','YELLOW'], ngenes)
+    genes ['gene'] = ["g%d" % k for k in range (ngenes)]
+    genes ['state9'] = rng.randint (1, 10, ngenes)
+    return genes
+
+def synthetic_reporters (N, nreporters=None, chromosome='2L', hic_res=2000, seed=None) :
+    """
+    Returns nreporters reporters (default: two per bin) on a chromosome of N
+    bins, with the type of read_data.load_reporters
+    """
+    rng = np.random.RandomState (seed)
+    if nreporters is None :
+        nreporters = 2*N
+    dtype = {'names' : reporter_names, 'formats' : reporter_formats}
+    reporters = np.zeros (nreporters, dtype=dtype)
+    reporters ['barcode'] = ["bc%d" % k for k in range (nreporters)]
+    reporters ['chr'] = chromosome
+    reporters ['strand'] = rng.choice (['+','-'], nreporters)
+    reporters ['pos'] = rng.randint (0, N*hic_res, nreporters)
+    reporters ['nexp'] = rng.randn (nreporters)
+    reporters ['prom'] = rng.choice (promoter_classes, nreporters)
+    reporters ['rep'] = rng.randint (1, 3, nreporters)
+    return reporters
+
+def synthetic_chromosome (N, seed=0) :
+    """
+    Returns a dict with the synthetic data of a chromosome of N bins: H, the
+    row-normalized P and its cumulative rows Pn (for do_the_search), zerorows,
+    genes, reporters, expr_binned and the gene matrix P_gene
+    """
+    zerorows = synthetic_zerorows (N, seed=seed)
+    H = synthetic_hic (N, zerorows=zerorows, seed=seed)
+    genes = synthetic_genes (N, seed=seed)
+    reporters = synthetic_reporters (N, seed=seed)
+    expr_binned = load_expr_binned (reporters, N)
+    P_gene = gene_expression_probability_matrix (N, genes, (always_fire,None), sparse=True)
+    P = row_normalize_matrix (H)
+    return {'N' : N, 'H' : H, 'P' : P, 'Pn' : np.cumsum (P, axis=1), 'zerorows' : zerorows,
+            'genes' : genes, 'reporters' : reporters, 'expr_binned' : expr_binned,
+            'P_gene' : P_gene}
+
+# benchmarks: each one is a function of the synthetic data returning the
+# function to time, and the maximum size it is run at (None for no limit)
+
+def _start (d) :
+    return int (np.argmax (~d ['zerorows']))
+
+def _mask (d) :
+    return np.logical_and (~np.isnan (d ['expr_binned']), ~d ['zerorows'])
+
+def _A (d) :
+    # as in the store of precompute, without the identity: the columns of the
+    # zero rows are empty
+    return exponential_matrix_sum (d ['P'], 5.)
+
+benchmarks = [
+    ('do_the_search',
+     lambda d : lambda : do_the_search (_start (d), 1000, d ['Pn']), None),
+    ('equilibrium_eigs',
+     lambda d : lambda : get_equilibrium_distribution (d ['P'], from_eigs=True), 10000),
+    ('equilibrium_iter',
+     lambda d : lambda : get_equilibrium_distribution (d ['P'], from_iter=True), None),
+    ('equilibrium_montecarlo',
+     lambda d : lambda : get_equilibrium_distribution (d ['P'], nsteps=10000, seed=0), None),
+    ('propagate_and_weigh',
+     lambda d : lambda : weigh_with_exponential (
+         propagate_dirac_comb (d ['P_gene'].sum (axis=1).A1, d ['P'], nsteps=100), 5.), None),
+    ('obj_diffusion',
+     lambda d : (lambda A, x, m : lambda : obj_diffusion (x, A, d ['expr_binned'], m)) (
+         _A (d), np.ones (d ['N'])/d ['N'], _mask (d)), 10000),
+    # SLSQP costs O(N^3) per iteration: 30 s at N=500
+    ('optimize_model',
+     lambda d : (lambda A, m : lambda : optimize_model ('diffusion', A, d ['expr_binned'], m,
+                                                       disp=False)) (_A (d), _mask (d)), 500),
+    ('optimize_model_softmax',
+     lambda d : (lambda A, m : lambda : optimize_model ('diffusion', A, d ['expr_binned'], m,
+                                                       disp=False, method='softmax')) (
+         _A (d), _mask (d)), 10000),
+    ('P_hop_plus_gene',
+     lambda d : lambda : P_hop_plus_gene (d ['P'], d ['P_gene'], 0.3), None),
+    ('load_expr_binned',
+     lambda d : lambda : load_expr_binned (d ['reporters'], d ['N']), None),
+]
+
+def measure (f, repeat=3) :
+    """
+    Runs f repeat times, and returns the best wall time, in seconds, and the
+    peak memory allocated during one run, in bytes
+    """
+    times = []
+    for r in range (repeat) :
+        t0 = time.perf_counter ()
+        f ()
+        times.append (time.perf_counter () - t0)
+    # the memory is traced in a separate run, as tracing slows down the code
+    tracemalloc.start ()
+    f ()
+    peak = tracemalloc.get_traced_memory () [1]
+    tracemalloc.stop ()
+    return min (times), peak
+
+def run_benchmarks (sizes=None, names=None, repeat=3, seed=0) :
+    """
+    Runs the benchmarks in names (default: all) for all the sizes, and
+    returns the list of the results, one dict per benchmark and size
+    """
+    if sizes is None :
+        sizes = default_sizes
+    results = []
+    for N in sizes :
+        log_message ("run_benchmarks", "Generating synthetic chromosome of %d bins" % N)
+        d = synthetic_chromosome (N, seed=seed)
+        for name, setup, max_size in benchmarks :
+            if names is not None and name not in names :
+                continue
+            if max_size is not None and N > max_size :
+                continue
+            np.random.seed (seed)
+            t, peak = measure (setup (d), repeat)
+            log_message ("run_benchmarks", "%s N=%d: %.4f s, %.1f MB" %
+                         (name, N, t, peak/1e6))
+            results.append ({'benchmark' : name, 'N' : N, 'time' : t,
+                             'peak_memory' : peak, 'repeat' : repeat})
+    return results
+
+# maximum import times, in seconds, of the package and of the submodules used
+# by the worker processes
+import_budgets = {
+    '' : 0.05,
+    'read_data' : 0.5,
+    'data_process' : 0.5,
+    'chromosome' : 0.5,
+    'sims' : 0.5,
+}
+
+def import_time (module, repeat=5) :
+    """
+    Returns the best time, in seconds, needed to import module in a new
+    interpreter, not counting the start of the interpreter
+    """
+    code = "import time; t=time.perf_counter (); import %s; print (time.perf_counter ()-t)" % module
+    env = dict (os.environ, PYTHONPATH=os.pathsep.join ([p for p in sys.path if p]))
+    times = []
+    for r in range (repeat) :
+        out = subprocess.check_output ([sys.executable, "-c", code], env=env)
+        times.append (float (out.decode ().strip ().splitlines () [-1]))
+    return min (times)
+
+def run_import_benchmarks (repeat=5) :
+    """
+    Measures the import times of the package and of the submodules of
+    import_budgets. Return the results, as run_benchmarks, and the list of
+    (module, time, budget) of the imports over their budget
+    """
+    package = __package__
+    results = []
+    over = []
+    for submodule, budget in sorted (import_budgets.items ()) :
+        module = "%s.%s" % (package, submodule) if submodule else package
+        t = import_time (module, repeat)
+        log_message ("run_import_benchmarks", "import %s: %.4f s" % (module, t))
+        results.append ({'benchmark' : "import %s" % module, 'N' : 0, 'time' : t,
+                         'peak_memory' : 0, 'repeat' : repeat})
+        if t > budget :
+            over.append ((module, t, budget))
+    return results, over
+
+def save_results (results, fname) :
+    """
+    Writes the results to fname as JSON, with a description of the platform
+    """
+    with open (fname, 'w') as f :
+        json.dump ({'python' : sys.version.split () [0], 'numpy' : np.__version__,
+                    'platform' : platform.platform (), 'date' : time.strftime ("%Y-%m-%d %H:%M:%S"),
+                    'results' : results}, f, indent=1)
+
+def load_results (fname) :
+    with open (fname, 'r') as f :
+        return json.load (f) ['results']
+
+def compare_results (old, new, threshold=1.2) :
+    """
+    Returns the regressions of the results new with respect to old: the list
+    of (benchmark, N, quantity, old value, new value) where time or
+    peak_memory grew by more than the factor threshold
+    """
+    old = dict ([((r ['benchmark'], r ['N']), r) for r in old])
+    regressions = []
+    for r in new :
+        o = old.get ((r ['benchmark'], r ['N']))
+        if o is None :
+            continue
+        for q in ('time', 'peak_memory') :
+            if r [q] > threshold*o [q] :
+                regressions.append ((r ['benchmark'], r ['N'], q, o [q], r [q]))
+    return regressions
+
+# regression checks: each one returns the list of the problems found
+
+def check_objective_zero_rows (what='diffusion', N=200, seed=0) :
+    """
+    Checks that the optimization of the start vector gives finite results, and
+    does not stop at the first iteration, on a chromosome with zero rows
+    """
+    d = synthetic_chromosome (N, seed=seed)
+    if what == 'diffusion' :
+        optimize, A = optimize_start_diffusion, _A (d)
+    else :
+        optimize, A = optimize_start_contacts, d ['P']
+    problems = []
+    for method in ('SLSQP', 'softmax') :
+        res = optimize (np.ones (N)/N, A, d ['expr_binned'], _mask (d),
+                        disp=False, method=method, maxiter=20)
+        if not np.isfinite (res.fun) or not np.all (np.isfinite (res.x)) or res.nit <= 1 :
+            problems.append ("%s %s: f = %g after %d iterations" % (what, method, res.fun, res.nit))
+    return problems
+
+class _SyntheticChromosome :
+    # the attributes of a Chromosome object needed by resolution_pyramid
+    def __init__ (self, d) :
+        self.H = d ['H']
+        self.zerorows = d ['zerorows']
+        self.genes = d ['genes']
+        self.reporters = d ['reporters']
+        self.expr_binned = d ['expr_binned']
+
+def check_pyramid_zero_rows (N=256, factors=(1,2,4), seed=0) :
+    """
+    Checks that the coarse-to-fine optimization, with the default matrix A_tau
+    (without the identity), gives finite results at all the levels of the
+    pyramid of a chromosome with zero rows
+    """
+    d = synthetic_chromosome (N, seed=seed)
+    levels = resolution_pyramid (_SyntheticChromosome (d), factors=factors)
+    problems = []
+    for method in ('SLSQP', 'softmax') :
+        res, results = optimize_coarse_to_fine (levels, tau=5., method=method, maxiter=20,
+                                                seed=seed)
+        for level, r in zip (levels, results) :
+            if not np.isfinite (r.fun) or not np.all (np.isfinite (r.x)) or r.nit <= 1 :
+                problems.append ("%s, factor %d: f = %g after %d iterations" %
+                                 (method, level.factor, r.fun, r.nit))
+    return problems
+
+# modules that the loaders must not import, as they are slow to import
+heavy_modules = ['scipy.sparse.linalg', 'scipy.optimize', 'scipy.stats', 'matplotlib']
+
+def check_light_imports (modules=('read_data', 'data_process', 'cache', 'binning')) :
+    """
+    Checks that importing the modules, in a new interpreter, does not import
+    the heavy_modules
+    """
+    problems = []
+    env = dict (os.environ, PYTHONPATH=os.pathsep.join ([p for p in sys.path if p]))
+    for module in modules :
+        code = "import sys, %s.%s; print (' '.join ([m for m in %r if m in sys.modules]))" % \
+            (__package__, module, heavy_modules)
+        out = subprocess.check_output ([sys.executable, "-c", code], env=env)
+        loaded = out.decode ().strip ().splitlines ()
+        if loaded and loaded [-1] :
+            problems.append ("importing %s imports %s" % (module, loaded [-1]))
+    return problems
+
+def public_names (fname) :
+    """
+    Returns the public names defined at the top level of the module fname:
+    the functions, classes and variables that do not start with _
+    """
+    with open (fname) as f :
+        tree = ast.parse (f.read (), fname)
+    names = []
+    for node in tree.body :
+        if isinstance (node, (ast.FunctionDef, ast.ClassDef)) :
+            names.append (node.name)
+        elif isinstance (node, ast.Assign) :
+            names += [t.id for t in node.targets if isinstance (t, ast.Name)]
+    return set ([name for name in names if not name.startswith ('_')])
+
+def check_exports () :
+    """
+    Checks that the names exported by the package are the public names of
+    each submodule
+    """
+    package = importlib.import_module (__package__)
+    problems = []
+    for module, names in package._exports :
+        fname = os.path.join (os.path.dirname (package.__file__), module + ".py")
+        defined = public_names (fname)
+        missing = sorted (defined - set (names))
+        extra = sorted (set (names) - defined)
+        if missing :
+            problems.append ("%s: not exported: %s" % (module, ", ".join (missing)))
+        if extra :
+            problems.append ("%s: not defined: %s" % (module, ", ".join (extra)))
+    return problems
+
+checks = [
+    ('objective_zero_rows_diffusion', lambda : check_objective_zero_rows ('diffusion')),
+    ('objective_zero_rows_contacts', lambda : check_objective_zero_rows ('contacts')),
+    ('pyramid_zero_rows', check_pyramid_zero_rows),
+    ('light_imports', check_light_imports),
+    ('exports', check_exports),
+]
+
+def run_checks (names=None) :
+    """
+    Runs the regression checks in names (default: all), and returns the list
+    of the problems found
+    """
+    problems = []
+    for name, check in checks :
+        if names is not None and name not in names :
+            continue
+        found = check ()
+        log_message ("run_checks", "%s: %s" % (name, "FAILED" if found else "ok"))
+        problems += ["%s: %s" % (name, p) for p in found]
+    return problems
+
+def main () :
+    parser = argparse.ArgumentParser (description="Benchmark the hot paths on synthetic data")
+    parser.add_argument ("--sizes", type=int, nargs='+', default=default_sizes,
+                         help="numbers of bins of the synthetic chromosomes")
+    parser.add_argument ("--only", nargs='+', default=None,
+                         help="benchmarks to run (default: all)")
+    parser.add_argument ("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument ("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument ("-o", "--output", default=None, help="JSON file of the results")
+    parser.add_argument ("--compare", default=None, help="JSON file of previous results")
+    parser.add_argument ("--threshold", type=float, default=1.2,
+                         help="slowdown factor reported as a regression")
+    parser.add_argument ("--imports", action='store_true',
+                         help="measure the import times and check their budgets")
+    parser.add_argument ("--checks", action='store_true',
+                         help="run the regression checks instead of the benchmarks")
+    args = parser.parse_args ()
+    if args.checks :
+        problems = run_checks (args.only)
+        for p in problems :
+            warn_message ("benchmarks", p)
+        sys.exit (1 if problems else 0)
+    results = run_benchmarks (args.sizes, args.only, args.repeat, args.seed)
+    over = []
+    if args.imports :
+        import_results, over = run_import_benchmarks ()
+        results += import_results
+        for module, t, budget in over :
+            warn_message ("benchmarks", "import %s: %.4f s, budget %.4f s" % (module, t, budget))
+    if args.output is not None :
+        save_results (results, args.output)
+    if args.compare is not None :
+        regressions = compare_results (load_results (args.compare), results, args.threshold)
+        for name, N, q, o, n in regressions :
+            warn_message ("benchmarks", "%s N=%d: %s %.4g -> %.4g" % (name, N, q, o, n))
+        if regressions :
+            sys.exit (1)
+    if over :
+        sys.exit (1)
+
+if __name__ == '__main__' :
+    main ()
@@ -0,0 +1,67 @@
+"""
+Vectorized mapping of genomic features (genes, reporters, promoters) to the
+bins of the Hi-C matrices.
+"""
+import numpy as np
+from .messages import warn_message
+
+def bin_index (pos, hic_res=2000) :
+    """
+    Returns the indices of the bins of size hic_res containing the positions
+    pos (integer division, also on Python 3)
+    """
+    return np.floor_divide (np.asarray (pos), hic_res).astype (np.intp)
+
+def field_isin (values, labels) :
+    """
+    Returns a boolean mask telling which values of a string field of a
+    structured array are in labels. The labels are converted to the type of
+    the field, so that byte strings and str can be compared on Python 3
+    """
+    values = np.asarray (values)
+    return np.isin (values, np.array (labels, dtype=values.dtype))
+
+def in_range (idx, nsites, program_name="in_range") :
+    """
+    Returns a boolean mask telling which bin indices are valid for a matrix
+    of nsites bins, and warns about the ones that are not. idx can be a tuple
+    of index arrays (e.g. rows and columns), in which case all of them must be
+    valid
+    """
+    if not isinstance (idx, tuple) :
+        idx = (idx,)
+    valid = np.ones (len (idx [0]), dtype=bool)
+    for i in idx :
+        valid &= np.logical_and (i >= 0, i < nsites)
+    nout = len (valid) - np.count_nonzero (valid)
+    if nout > 0 :
+        warn_message (program_name, "%d indices out of range" % nout)
+    return valid
+
+def bin_counts (idx, nsites, weights=None, program_name="bin_counts") :
+    """
+    Returns the number of features (or the sum of their weights) in each of
+    the nsites bins, given their bin indices. Indices out of range are
+    reported and ignored
+    """
+    valid = in_range (idx, nsites, program_name)
+    if weights is not None :
+        weights = np.asarray (weights, dtype=float) [valid]
+    return np.bincount (idx [valid], weights=weights, minlength=nsites).astype (float)
+
+def gene_ends (genes, promoter_distance=0, strict=False) :
+    """
+    Returns the positions of the promoters and terminators of the genes,
+    taking into account the strand. The promoters are moved upstream by
+    promoter_distance. Genes that are not on the '+' strand are considered on
+    the '-' strand, unless strict is True, in which case a ValueError is raised
+    for strands other than '+' and '-'
+    """
+    plus = field_isin (genes ['strand'], ['+'])
+    if strict and not np.all (plus | field_isin (genes ['strand'], ['-'])) :
+        raise ValueError ("Unknown strand in genes")
+    start = genes ['start']
+    end = genes ['end']
+    promoters = np.where (plus, start-promoter_distance, end+promoter_distance)
+    terminators = np.where (plus, end, start)
+    return promoters, terminators
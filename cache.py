@@ -0,0 +1,151 @@
+"""
+Binary cache of the data files. Each source file is converted once to a binary
+file (.npy for arrays, .npz for sparse matrices) in cache_dir. The name of the
+cache file contains a key computed from the path of the source, and a key
+computed from its path, modification time and size, so that a cache file is
+valid as long as its source is unchanged: when the source changes, the cache
+is rebuilt and the stale files of the same source are removed. Arrays are opened as memory maps, so that all
+the processes running on a node share the same pages.
+
+The cache of the Hi-C matrices can be warmed with:
+
+    python -m triplib.warm_cache [--raw] [--sparse] [--max-distance N] [chromosomes]
+"""
+import numpy as np
+import os, glob, hashlib, collections
+import scipy.sparse
+from .messages import warn_message
+
+# module-wide variables
+cache_dir = os.getenv ("HOME") + "/work/data/tripsims/cache"
+
+def source_key (source) :
+    """
+    Returns the key identifying the current version of the source file
+    """
+    st = os.stat (source)
+    s = "%s:%d:%d" % (os.path.abspath (source), st.st_mtime_ns, st.st_size)
+    return hashlib.sha1 (s.encode ()).hexdigest () [:16]
+
+def path_key (source) :
+    """
+    Returns the key identifying the source file by its path, whatever its
+    version
+    """
+    return hashlib.sha1 (os.path.abspath (source).encode ()).hexdigest () [:8]
+
+def _prefix (source, tag) :
+    stem = os.path.basename (source).split ('.') [0]
+    return "%s/%s-%s-%s" % (cache_dir, stem, tag, path_key (source))
+
+def cache_file (source, tag, ext) :
+    """
+    Returns the name of the cache file of the source, for the variant
+    identified by tag
+    """
+    return "%s-%s%s" % (_prefix (source, tag), source_key (source), ext)
+
+def remove_stale (source, tag, ext) :
+    """
+    Removes the cache files of the source that were built from a previous
+    version of it. The files of the sources with the same name in other
+    directories have another path_key, and are kept
+    """
+    current = cache_file (source, tag, ext)
+    pattern = "%s-%s%s" % (_prefix (source, tag), '?'*16, ext)
+    for fname in glob.glob (pattern) :
+        if fname != current :
+            os.remove (fname)
+
+def _save (fname, data) :
+    # write to a temporary file and rename, so that other processes never read
+    # a partially written file
+    tmp = "%s.%d.tmp" % (fname, os.getpid ())
+    with open (tmp, 'wb') as f :
+        if scipy.sparse.issparse (data) :
+            scipy.sparse.save_npz (f, data.tocsr (), compressed=False)
+        else :
+            np.save (f, data)
+    os.rename (tmp, fname)
+
+def _load (fname, ext, mmap_mode) :
+    if ext == '.npz' :
+        return scipy.sparse.load_npz (fname)
+    else :
+        return np.load (fname, mmap_mode=mmap_mode)
+
+def load_cached (source, build, tag='data', sparse=False, mmap_mode='r') :
+    """
+    Returns the data parsed from source by the function build, from the binary
+    cache if it is valid. Otherwise, build the data and write the cache. Dense
+    arrays are opened with the given mmap_mode
+    """
+    ext = '.npz' if sparse else '.npy'
+    fname = cache_file (source, tag, ext)
+    if os.path.exists (fname) :
+        return _load (fname, ext, mmap_mode)
+    data = build ()
+    try :
+        if not os.path.exists (cache_dir) :
+            os.makedirs (cache_dir)
+        _save (fname, data)
+        remove_stale (source, tag, ext)
+    except (IOError, OSError) as e :
+        warn_message ("load_cached", "Could not write cache of %s: %s" % (source, e))
+        return data
+    return _load (fname, ext, mmap_mode)
+
+def clear_cache () :
+    """
+    Removes all the files in the cache
+    """
+    for fname in glob.glob ("%s/*.np[yz]" % cache_dir) :
+        os.remove (fname)
+
+def nbytes (value) :
+    """
+    Returns the memory used by a dense or sparse array
+    """
+    if scipy.sparse.issparse (value) :
+        value = scipy.sparse.csr_matrix (value)
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return getattr (value, 'nbytes', 0)
+
+class LRUCache :
+    """
+    In-memory cache that keeps the most recently used items, within a budget
+    of max_items items and max_bytes bytes (None meaning no limit). The most
+    recent item is always kept, even if it is larger than max_bytes. Items
+    are evicted before a new one is loaded, so that the budget of max_items
+    holds while it is loaded too.
+    """
+    def __init__ (self, max_items=None, max_bytes=None) :
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict ()
+    def total_bytes (self) :
+        return sum ([nbytes (v) for v in self.items.values ()])
+    def get (self, key, load) :
+        """
+        Returns the item key, calling load () to get it if it is not cached
+        """
+        if key in self.items :
+            value = self.items.pop (key)
+        else :
+            self._evict (room=1)
+            value = load ()
+        self.items [key] = value
+        self._evict ()
+        return value
+    def _evict (self, room=0) :
+        # room is the number of items about to be added
+        while len (self.items) > 1-room and \
+              ((self.max_items is not None and len (self.items)+room > self.max_items) or
+               (self.max_bytes is not None and self.total_bytes () > self.max_bytes)) :
+            self.items.popitem (last=False)
+    def set_budget (self, max_items=None, max_bytes=None) :
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._evict ()
+    def clear (self) :
+        self.items.clear ()
@@ -1,28 +1,71 @@
 import numpy as np
 from .read_data import *
-from .data_process import log_message
+from .messages import log_message
+from .features import FeatureIndex, select_chromosome
+from .instrument import span
 
 class Chromosome :
-    def __init__(self,name,full_init=True,normalized=True,colors=None,reporters=None,genes=None) :
+    """
+    A chromosome arm. All the data are loaded on first access: N and zerorows
+    are read once per process, the features of the chromosome are selected
+    from the genome-wide tables when first used, and the Hi-C matrix H is not
+    kept by the object but taken from the process-wide cache of read_data
+    (see get_hic and set_hic_cache_budget), so that a loop over the arms
+    holds at most as many matrices as the cache allows.
+    """
+    def __init__(self,name,full_init=True,normalized=True,colors=None,reporters=None,genes=None,
+                 sparse=False,max_distance=None) :
         self.name = name
-        self.colors = None
-        self.reporters = None
-        self.genes = None
-        self.H = None
-        # load the number of bins in the Hi-C matrix and zerorows
-        self.N = chromosome_N (name)
-        self.zerorows = chromosome_zerorows (name)
+        self.sparse = sparse
+        self.max_distance = max_distance
+        self.normalized = normalized
+        self._with_hic = False
+        self._tables = {'colors' : None, 'reporters' : None, 'genes' : None}
         # if user wishes, we init all
         self.init_all (colors,reporters,genes,full_init=full_init,normalized=normalized)
+    def __getattr__ (self,attr) :
+        # called only for the attributes that are not set yet: load them
+        if attr.startswith ('_') :
+            raise AttributeError (attr)
+        with span ("Chromosome.%s" % attr) :
+            return self._load (attr)
+    def _load (self,attr) :
+        if attr == 'H' :
+            if not self._with_hic :
+                return None
+            return get_hic (self.name,normalized=self.normalized,
+                            sparse=self.sparse,max_distance=self.max_distance)
+        if attr == 'N' :
+            value = chromosome_N (self.name)
+        elif attr == 'zerorows' :
+            value = chromosome_zerorows (self.name)
+        elif attr in self._tables :
+            table = self._tables [attr]
+            value = None if table is None else select_chromosome (table,self.name)
+        elif attr == 'expr_binned' :
+            if self.reporters is None :
+                return None
+            value = load_expr_binned (self.reporters,self.N)
+        else :
+            raise AttributeError (attr)
+        setattr (self,attr,value)
+        return value
+    def _set_table (self,attr,table) :
+        self._tables [attr] = table
+        self.__dict__.pop (attr,None)
+    # the feature tables can be genome-wide arrays or FeatureIndex objects,
+    # in which case the features of the chromosome are views of the index
     def init_colors (self,colors) :
-        self.colors = np.array ([c for c in colors if c['chr']==self.name])
+        self._set_table ('colors',colors)
     def init_reporters (self,reporters) :
-        self.reporters = np.array ([r for r in reporters if r['chr']==self.name])
-        self.expr_binned = load_expr_binned (self.reporters,self.N)
+        self._set_table ('reporters',reporters)
+        self.__dict__.pop ('expr_binned',None)
     def init_genes (self,genes) :
-        self.genes = np.array ([g for g in genes if g['chr']==self.name])
+        self._set_table ('genes',genes)
     def init_hic (self,normalized=True) :
-        self.H = load_hic (self.name,normalized=normalized)
+        self.normalized = normalized
+        self._with_hic = True
+        self.__dict__.pop ('H',None)
     def init_all (self,colors,reporters,genes,full_init=False,normalized=True) :
         self.init_colors (colors)
         self.init_reporters (reporters)
@@ -30,12 +73,13 @@ class Chromosome :
         if full_init :
             self.init_hic (normalized=normalized)
 
-def load_all_chromosomes (full_init=True,normalized=True) :
-    names = ['2L','2R','3L','3R','X']
+@span ("load_all_chromosomes")
+def load_all_chromosomes (full_init=True,normalized=True,sparse=False,max_distance=None) :
+    names = chromosome_names
     log_message ("load_all_chromosomes", "Loading reporters")
-    reporters = load_reporters ()
-    genes = load_genes ()
-    colors = load_colors ()
+    reporters = FeatureIndex (load_reporters (),pos_field='pos')
+    genes = FeatureIndex (load_genes ())
+    colors = FeatureIndex (load_colors ())
     chromosomes = []
     for name in names :
         log_message ("load_all_chromosomes", "Loading chromosome %s"%name)
@@ -44,7 +88,9 @@ def load_all_chromosomes (full_init=True,normalized=True) :
                                         normalized=normalized,
                                         colors=colors,
                                         reporters=reporters,
-                                        genes=genes))
+                                        genes=genes,
+                                        sparse=sparse,
+                                        max_distance=max_distance))
     del reporters
     del genes
     del colors
@@ -1,35 +1,80 @@
-from __future__ import print_function
 import numpy as np
-import time, sys
+import scipy.sparse
+# the messages were defined here, and are still imported from here
+from .messages import time_string, error_message, log_message, warn_message
+from .binning import bin_index, bin_counts, gene_ends
 
-def time_string () :
-    return time.strftime("[%Y-%m-%d %H:%M:%S]", time.localtime ())
-
-def error_message (program_name, message) :
-    full_message = "%s %s: ERROR: %s"%(time_string (), program_name, message)
-    print (full_message, file=sys.stderr)
-
-def log_message (program_name, message) :
-    full_message = "%s %s: INFO: %s"%(time_string (), program_name, message)
-    print (full_message)
-
-def warn_message (program_name, message) :
-    full_message = "%s %s: WARNING: %s"%(time_string (), program_name, message)
-    print (full_message)
+class ModelScorer :
+    """
+    Scoring of many populations against the same binned reporter expression.
+    The mask of the valid bins (not NaN and not in zerorows) and the centered
+    expression are computed once; the populations are given as a K*N matrix
+    (or a single vector of N bins), and are processed chunk_size rows at a
+    time, so that they can be memory-mapped stacks larger than the RAM. The
+    populations are compared with the expression as log2 (bias + population)
+    """
+    def __init__ (self, expr_binned, zerorows=None, bias=0.01, chunk_size=1024) :
+        mask = ~np.isnan (expr_binned)
+        if zerorows is not None :
+            mask = np.logical_and (mask, ~zerorows)
+        self.idx = np.nonzero (mask) [0]
+        self.bias = bias
+        self.chunk_size = chunk_size
+        self.x = np.asarray (expr_binned) [self.idx]
+        self.xc = self.x - self.x.mean ()
+        self.xnorm = np.sqrt (np.dot (self.xc, self.xc))
+        # the centered ranks of the expression, computed on the first call
+        # of spearman
+        self.xrc = None
+        self.xrnorm = None
+    def _score (self, populations, f) :
+        single = np.ndim (populations) == 1
+        if single :
+            populations = np.reshape (populations, (1,-1))
+        K = populations.shape [0]
+        scores = np.empty (K)
+        for k in range (0, K, self.chunk_size) :
+            chunk = np.asarray (populations [k:k+self.chunk_size]) [:,self.idx]
+            scores [k:k+self.chunk_size] = f (np.log2 (self.bias + chunk))
+        if single :
+            return scores [0]
+        return scores
+    def _correlation (self, Y, xc, xnorm) :
+        Yc = Y - Y.mean (axis=1).reshape (-1,1)
+        with np.errstate (divide='ignore', invalid='ignore') :
+            return np.dot (Yc, xc) / (np.sqrt (np.einsum ('ij,ij->i', Yc, Yc))*xnorm)
+    def r2 (self, populations) :
+        """
+        Returns the R2 of the populations (Pearson correlation squared)
+        """
+        return self._score (populations,
+                            lambda Y : self._correlation (Y, self.xc, self.xnorm)**2)
+    def spearman (self, populations) :
+        """
+        Returns the Spearman rank correlation of the populations
+        """
+        from scipy.stats import rankdata
+        if self.xrc is None :
+            xr = rankdata (self.x)
+            self.xrc = xr - xr.mean ()
+            self.xrnorm = np.sqrt (np.dot (self.xrc, self.xrc))
+        return self._score (populations,
+                            lambda Y : self._correlation (rankdata (Y, axis=1),
+                                                          self.xrc, self.xrnorm))
+    def mse (self, populations) :
+        """
+        Returns the mean squared error of the populations
+        """
+        return self._score (populations, lambda Y : np.mean ((Y-self.x)**2, axis=1))
 
 def model_r2 (population, expr_binned, bias=0.01, zerorows=None) :
     """
     Returns the R2 of the population, compared with the binned reporter
-    expression
+    expression. population can also be a K*N matrix of populations, in which
+    case the K values of R2 are returned. To score populations against the
+    same expression repeatedly, use a ModelScorer
     """
-    notnan = np.isnan (expr_binned)
-    if zerorows is not None :
-        mask = np.logical_and (~notnan, ~zerorows)
-    else :
-        mask = ~notnan
-    x = expr_binned [mask]
-    y = np.log2 (bias + population [mask])
-    return np.corrcoef (x,y)[0,1]**2
+    return ModelScorer (expr_binned, zerorows, bias).r2 (population)
 
 def ps (s,alpha) :
     """
@@ -40,61 +85,135 @@ def ps (s,alpha) :
     else :
         return np.power (s,-alpha)
 
+def ps_kernel (N,alpha,max_distance=None) :
+    """
+    Returns the values of the p(s) function with exponent alpha for the
+    distances s=0,...,N-1, with p(0)=0, and p(s)=0 beyond max_distance
+    """
+    k = np.zeros (N)
+    k [1:] = np.power (np.arange (1,N,dtype=float), -alpha)
+    if max_distance is not None :
+        k [max_distance+1:] = 0.
+    return k
+
 def fill_p_with_ps (P,i,alpha) :
     """
     Fills the i-th row and column of P with values given
-    by the p(s) function
+    by the p(s) function. P can be dense or a sparse LIL matrix
     """
     dim = P.shape[0]
-    for k in range (dim) :
-        s = abs(i-k)
-        P[i,k] = ps(s,alpha)
-        P[k,i] = ps(s,alpha)
+    p = ps_kernel (dim,alpha) [np.abs (i-np.arange (dim))]
+    P[i,:] = p
+    P[:,i] = p.reshape (dim,1) if scipy.sparse.issparse (P) else p
+
+def power_law_matrix (N,alpha,max_distance=None,sparse=False) :
+    """
+    Returns the N*N matrix P_ij = p(|i-j|) for the p(s) function with exponent
+    alpha, that is the matrix obtained by filling all the rows with
+    fill_p_with_ps. If max_distance is given, only the band within
+    max_distance from the diagonal is filled. If sparse is True, the matrix
+    is returned in CSR format
+    """
+    k = ps_kernel (N,alpha,max_distance)
+    if sparse :
+        d = N-1 if max_distance is None else min (max_distance,N-1)
+        offsets = [s for s in range (-d,d+1) if s!=0]
+        diagonals = [np.full (N-abs (s), k [abs (s)]) for s in offsets]
+        return scipy.sparse.diags (diagonals, offsets, shape=(N,N), format='csr')
+    from scipy.linalg import toeplitz
+    return toeplitz (k)
 
-def row_normalize_matrix (M) :
+def band_matrix (M, max_distance) :
+    """
+    Returns a copy of the dense or sparse matrix M where only the entries
+    within max_distance from the diagonal are kept. Sparse matrices are
+    returned in CSR format
+    """
+    if scipy.sparse.issparse (M) :
+        M = M.tocoo ()
+        keep = np.abs (M.row-M.col) <= max_distance
+        return scipy.sparse.csr_matrix ((M.data [keep], (M.row [keep], M.col [keep])),
+                                        shape=M.shape)
+    else :
+        return np.triu (np.tril (M, max_distance), -max_distance)
+
+def row_normalize_matrix (M, out=None) :
+    """
+    Returns the matrix M with each nonzero row divided by its sum. For dense
+    matrices, the result can be written in out, which can be M itself to
+    normalize in place. Sparse matrices are returned in CSR format. The
+    result has the floating type of M (float64 for integer matrices), so
+    that float32 matrices stay in float32
+    """
+    dtype = np.result_type (M.dtype, np.float32)
     n = np.sum (M,axis=1)
-    N = M.shape [0]
-    Mnorm = M.copy ()
-    for i in range (N) :
-        if n[i]!=0. :
-            Mnorm[i] /= n[i]
-    return Mnorm
+    if scipy.sparse.issparse (M) :
+        n = np.asarray (n).ravel ()
+    inv = np.ones (len (n))
+    inv [n!=0.] = 1./n [n!=0.]
+    if scipy.sparse.issparse (M) :
+        return scipy.sparse.diags (inv.astype (dtype)).dot (M).tocsr ()
+    if out is None :
+        out = np.empty (M.shape, dtype=dtype)
+    return np.multiply (M, inv.reshape (-1,1).astype (dtype), out=out)
+
+class HopGeneMixer :
+    """
+    Mixing of the hopping matrix P_hop with the gene matrix P_gene, as done by
+    P_hop_plus_gene, for many values of p_firing. The row-normalized gene
+    matrix is computed once and kept in sparse format, so that each call only
+    recomputes the p_firing combination:
+
+        P = P_hop                                    for rows without genes
+        P = (1-p_firing) P_hop + p_firing P_gene/n   for rows with genes
+
+    where n are the row sums of P_gene. If normalize is True, P_hop is
+    row-normalized once at construction.
+    """
+    def __init__ (self, P_hop, P_gene, normalize=False) :
+        if normalize :
+            P_hop = row_normalize_matrix (P_hop)
+        self.P_hop = P_hop
+        G = scipy.sparse.csr_matrix (P_gene)
+        n = np.asarray (G.sum (axis=1)).ravel ()
+        self.has_gene = n!=0.
+        self.gene_rows = np.nonzero (self.has_gene) [0]
+        self.G = scipy.sparse.coo_matrix (row_normalize_matrix (G))
+        self.G.sum_duplicates ()
+    def __call__ (self, p_firing, out=None) :
+        """
+        Returns the mixed matrix for p_firing. For dense P_hop, the result can
+        be written in the buffer out, that is reused across calls
+        """
+        a = np.ones (self.P_hop.shape [0])
+        a [self.has_gene] = 1.-p_firing
+        if scipy.sparse.issparse (self.P_hop) :
+            P = scipy.sparse.diags (a).dot (self.P_hop) + p_firing*self.G
+            return scipy.sparse.csr_matrix (P)
+        if out is None :
+            out = np.empty (self.P_hop.shape)
+        out [:] = self.P_hop
+        out [self.gene_rows] *= a [self.gene_rows].reshape (-1,1)
+        out [self.G.row,self.G.col] += p_firing*self.G.data
+        return out
 
-def P_hop_plus_gene (P_hop, P_gene, p_firing) :
-    N = P_hop.shape[0]
-    P = np.zeros ([N,N])
-    for i in range (N) :
-        n = np.sum (P_gene [i,:])
-        if n!=0. :
-            P [i,:] = p_firing*P_gene[i,:]/n + (1.-p_firing)*P_hop[i,:]
-        else :
-            P [i,:] = P_hop [i,:]
-    return P
+def P_hop_plus_gene (P_hop, P_gene, p_firing, out=None) :
+    """
+    Mix the hopping matrix P_hop and the gene matrix P_gene (dense or sparse)
+    with probability p_firing, see HopGeneMixer. When sweeping over p_firing,
+    use a HopGeneMixer directly, to normalize P_gene only once
+    """
+    return HopGeneMixer (P_hop, P_gene) (p_firing, out=out)
 
 def get_promoters_and_terminators (genes, N, hic_res=2000) :
     """
     Given the gene array "genes", extract positions of promoters
     and terminators, and both, into an array of N bins.
     """
-    promoters = np.zeros (N)
-    terminators = np.zeros (N)
-    both = np.zeros (N)
-    for gene in genes :
-        startsite = gene ['start']
-        endsite = gene ['end']
-        strand = gene ['strand']
-        # IMPORTANT NOTE: here we suppose that we are using Python 2! The division
-        # between integers in Python 3 yields a float.
-        if strand == '+' :
-            i = startsite/hic_res
-            j = endsite/hic_res
-        elif strand == '-' :
-            i = endsite/hic_res
-            j = startsite/hic_res
-        else :
-            raise ValueError
-        promoters [i] += 1
-        terminators [j] += 1
-        both [i] += 1
-        both [j] += 1
+    startsites, endsites = gene_ends (genes, strict=True)
+    i = bin_index (startsites, hic_res)
+    j = bin_index (endsites, hic_res)
+    promoters = bin_counts (i, N, program_name="get_promoters_and_terminators")
+    terminators = bin_counts (j, N, program_name="get_promoters_and_terminators")
+    both = promoters + terminators
     return promoters, terminators, both
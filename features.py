@@ -0,0 +1,77 @@
+"""
+Chromosome-indexed storage of the genome-wide feature tables (genes, colors,
+reporters). Each table is sorted once by chromosome and position, so that the
+features of a chromosome are a contiguous slice of the table (a view, no copy)
+and the features in an interval are found by binary search.
+"""
+import numpy as np
+
+def _name (chromosome) :
+    if isinstance (chromosome, bytes) :
+        return chromosome.decode ()
+    return str (chromosome)
+
+class FeatureIndex :
+    """
+    Index of a genome-wide structured array with a 'chr' field and a position
+    field pos_field ('start' for genes and colors, 'pos' for reporters).
+    """
+    def __init__ (self, table, pos_field='start') :
+        order = np.lexsort ((table [pos_field], table ['chr']))
+        self.table = table [order]
+        self.pos_field = pos_field
+        names, starts = np.unique (self.table ['chr'], return_index=True)
+        ends = np.append (starts [1:], len (self.table))
+        self.offsets = dict ([(_name (n), (s, e)) for n, s, e in zip (names, starts, ends)])
+    def names (self) :
+        return sorted (self.offsets.keys ())
+    def chromosome (self, chromosome) :
+        """
+        Returns the features of the chromosome, as a view of the table
+        """
+        start, end = self.offsets.get (_name (chromosome), (0, 0))
+        return self.table [start:end]
+    def query (self, chromosome, start, end) :
+        """
+        Returns the features of the chromosome with position in [start, end),
+        as a view of the table
+        """
+        return _sorted_window (self.chromosome (chromosome), self.pos_field, start, end, 'left')
+    def window (self, chromosome, low, high) :
+        """
+        Returns the features of the chromosome with low < position < high, as
+        a view of the table
+        """
+        return _sorted_window (self.chromosome (chromosome), self.pos_field, low, high, 'right')
+
+def _sorted_window (features, pos_field, low, high, side) :
+    # binary search in features sorted by position; side is the side of low
+    pos = features [pos_field]
+    i = np.searchsorted (pos, low, side=side)
+    j = np.searchsorted (pos, high, side='left')
+    return features [i:j]
+
+def select_chromosome (table, chromosome) :
+    """
+    Returns the features of the chromosome, from a FeatureIndex (view) or from
+    a structured array (copy)
+    """
+    if isinstance (table, FeatureIndex) :
+        return table.chromosome (chromosome)
+    name = np.array (_name (chromosome), dtype=table ['chr'].dtype)
+    return table [table ['chr'] == name]
+
+def select_window (features, low, high, pos_field='start', sorted=False, chromosome=None) :
+    """
+    Returns the features with low < position < high. features can be a
+    FeatureIndex, with the chromosome given, or a structured array. If the
+    array is known to be sorted by position (sorted=True), as the features of a
+    chromosome of a FeatureIndex, the window is found by binary search and
+    returned as a view; otherwise, all the positions are compared
+    """
+    if isinstance (features, FeatureIndex) :
+        return features.window (chromosome, low, high)
+    if sorted :
+        return _sorted_window (features, pos_field, low, high, 'right')
+    pos = features [pos_field]
+    return features [np.logical_and (pos > low, pos < high)]
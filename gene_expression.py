@@ -1,50 +1,58 @@
 import numpy as np
-from .data_process import warn_message
+import scipy.sparse
+from .messages import warn_message
+from .binning import bin_index, in_range, gene_ends
 
 # assign the promoters
 def site_idx (n, hic_res=2000) :
-    return int (n/hic_res)
+    return int (n//hic_res)
 
 def gene_expression_probability_matrix (nsites, genes, Pfunc,
                                         hic_res=2000, promoter_distance=500,
                                        n_exclude_start=0,
-                                       n_exclude_end=0) :
-    Pg = np.zeros ([nsites,nsites])
+                                       n_exclude_end=0,
+                                       sparse=False) :
+    """
+    Returns the matrix of the probabilities of jumping from the promoter to
+    the terminator of the genes. Pfunc is a tuple (function, args), where the
+    firing function takes the whole gene array and args, and returns the
+    weight of each gene. Only the bins from n_exclude_start to n_exclude_end
+    are kept (n_exclude_end=0 or None meaning up to the last bin), so the
+    matrix has shape (n,n) with n = n_exclude_end-n_exclude_start. The matrix
+    is dense, or in CSR format if sparse is True
+    """
     pfunc = Pfunc[0]
     pfunc_args = Pfunc[1]
-    for gene in genes :
-        startsite = gene ['start']
-        endsite = gene ['end']
-        strand = gene ['strand']
-        if strand == '+' :
-            i = startsite - promoter_distance
-            j = endsite
-        else :
-            i = endsite + promoter_distance
-            j = startsite
-        i = site_idx (i, hic_res)
-        j = site_idx (j, hic_res)
-        try :
-            Pg [i,j] += pfunc (gene,pfunc_args)
-        except IndexError :
-            warn_message ("gene_exp", "Index error with %d/%d" % (startsite,endsite))
-            continue
-    return Pg [n_exclude_start:n_exclude_end,n_exclude_start:n_exclude_end]
+    startsites, endsites = gene_ends (genes, promoter_distance)
+    i = bin_index (startsites, hic_res)
+    j = bin_index (endsites, hic_res)
+    w = np.asarray (pfunc (genes,pfunc_args), dtype=float) * np.ones (len (genes))
+    valid = in_range ((i,j), nsites, "gene_exp")
+    # restrict to the window of bins that are kept
+    n1, n2, step = slice (n_exclude_start, n_exclude_end or None).indices (nsites)
+    n = max (0, n2-n1)
+    valid &= (i >= n1) & (i < n2) & (j >= n1) & (j < n2)
+    i, j, w = i [valid]-n1, j [valid]-n1, w [valid]
+    if sparse :
+        # duplicate entries are summed
+        return scipy.sparse.coo_matrix ((w,(i,j)), shape=(n,n)).tocsr ()
+    Pg = np.zeros ([n,n])
+    np.add.at (Pg, (i,j), w)
+    return Pg
+
+# the firing functions take the gene array and return the weight of each gene
 
 # the firing function default: fire if gene present
-def always_fire (gene,args) :
-    return 1.
+def always_fire (genes,args) :
+    return np.ones (len (genes))
 
 # fire if gene is active
-def fire_if_active (gene,args) :
-    if gene ['expr'] != 0. :
-        return 1.
-    else :
-        return 0.
+def fire_if_active (genes,args) :
+    return (genes ['expr'] != 0.).astype (float)
 
 # fire proportionally to gene expression level
-def linear_fire (gene,args) :
-    expr = gene ['expr']
+def linear_fire (genes,args) :
+    expr = genes ['expr']
     min_expression = args [0]
     max_expression = args [1]
     return (expr-min_expression)/(max_expression-min_expression)
@@ -0,0 +1,162 @@
+"""
+Instrumentation of the pipeline stages. A span is a named section of code,
+used as a context manager or as a decorator:
+
+    with span ("optimize chromosome 2L") :
+        ...
+
+    @span ("load_genes")
+    def load_genes (...) :
+
+Each span records its wall time, its CPU time, the change of the resident
+memory of the process between its start and its end (rss_delta, negative if
+memory was freed), and the counters added with add_count while it runs.
+Spans nest: each record keeps its depth and the name of its parent. The
+records are kept in memory, per process, and can be printed with
+print_trace_summary or saved as JSON (save_trace) or as a Chrome trace
+(save_chrome_trace, to be opened in chrome://tracing or Perfetto).
+
+The tracing is disabled by default, and then spans and counters cost only a
+function call. It is enabled with enable_tracing, or by setting the
+environment variable TRIPLIB_TRACE to a non-empty value.
+"""
+import os, time, json, functools
+try :
+    import resource
+except ImportError :
+    resource = None
+
+_enabled = bool (os.getenv ("TRIPLIB_TRACE"))
+
+# finished spans, and stack of the open ones
+_records = []
+_stack = []
+
+def enable_tracing (flag=True) :
+    global _enabled
+    _enabled = flag
+
+def reset_tracing () :
+    """
+    Forgets the recorded spans
+    """
+    del _records [:]
+
+def peak_rss () :
+    """
+    Returns the peak resident memory of the process, in bytes, or 0 if it is
+    not available
+    """
+    if resource is None :
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_rss () :
+    """
+    Returns the current resident memory of the process, in bytes, or 0 if it
+    is not available (it is read from /proc, on Linux)
+    """
+    try :
+        with open ("/proc/self/statm") as f :
+            return int (f.read ().split () [1]) * os.sysconf ("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError) :
+        return 0
+
+class span :
+    """
+    Context manager and decorator recording a span named name
+    """
+    def __init__ (self, name) :
+        self.name = name
+        self.record = None
+    def __enter__ (self) :
+        if _enabled :
+            self.record = {'name' : self.name, 'pid' : os.getpid (), 'depth' : len (_stack),
+                           'parent' : _stack [-1] ['name'] if _stack else None,
+                           'counters' : {}, 'start' : time.time ()}
+            self._wall = time.perf_counter ()
+            self._cpu = time.process_time ()
+            self._rss = current_rss ()
+            _stack.append (self.record)
+        return self
+    def __exit__ (self, *exc) :
+        record = self.record
+        if record is not None :
+            record ['wall'] = time.perf_counter () - self._wall
+            record ['cpu'] = time.process_time () - self._cpu
+            record ['rss_delta'] = current_rss () - self._rss
+            _stack.pop ()
+            _records.append (record)
+            self.record = None
+        return False
+    def __call__ (self, f) :
+        name = self.name
+        @functools.wraps (f)
+        def wrapper (*args, **kwargs) :
+            if not _enabled :
+                return f (*args, **kwargs)
+            with span (name) :
+                return f (*args, **kwargs)
+        return wrapper
+
+def add_count (name, n=1) :
+    """
+    Adds n to the counter name of the innermost open span
+    """
+    if _enabled and _stack :
+        # numpy scalars are converted, so that the counters can be saved as JSON
+        if hasattr (n, 'item') :
+            n = n.item ()
+        counters = _stack [-1] ['counters']
+        counters [name] = counters.get (name, 0) + n
+
+def trace_records () :
+    return list (_records)
+
+def trace_summary () :
+    """
+    Returns the recorded spans aggregated by name: a list of dicts with the
+    number of calls, the total wall and CPU times, the largest change of the
+    resident memory and the summed counters, sorted by decreasing total wall
+    time
+    """
+    summary = {}
+    for r in _records :
+        s = summary.setdefault (r ['name'], {'name' : r ['name'], 'calls' : 0, 'wall' : 0.,
+                                             'cpu' : 0., 'rss_delta' : None,
+                                             'counters' : {}})
+        s ['calls'] += 1
+        s ['wall'] += r ['wall']
+        s ['cpu'] += r ['cpu']
+        if s ['rss_delta'] is None or r ['rss_delta'] > s ['rss_delta'] :
+            s ['rss_delta'] = r ['rss_delta']
+        for k, v in r ['counters'].items () :
+            s ['counters'] [k] = s ['counters'].get (k, 0) + v
+    return sorted (summary.values (), key=lambda s : -s ['wall'])
+
+def print_trace_summary () :
+    print ("%-40s %8s %10s %10s %10s  %s" % ("span", "calls", "wall (s)", "cpu (s)",
+                                             "drss (MB)", "counters"))
+    for s in trace_summary () :
+        counters = " ".join (["%s=%s" % (k, v) for k, v in sorted (s ['counters'].items ())])
+        print ("%-40s %8d %10.3f %10.3f %10.1f  %s" % (s ['name'], s ['calls'], s ['wall'],
+                                                       s ['cpu'], s ['rss_delta']/1e6, counters))
+
+def save_trace (fname) :
+    """
+    Writes the recorded spans to fname as JSON
+    """
+    with open (fname, 'w') as f :
+        json.dump ({'records' : _records, 'summary' : trace_summary ()}, f, indent=1)
+
+def save_chrome_trace (fname) :
+    """
+    Writes the recorded spans to fname in the Chrome trace event format
+    """
+    events = [{'name' : r ['name'], 'ph' : 'X', 'pid' : r ['pid'], 'tid' : r ['pid'],
+               'ts' : r ['start']*1e6, 'dur' : r ['wall']*1e6,
+               'args' : dict (r ['counters'], cpu=r ['cpu'], rss_delta=r ['rss_delta'])}
+              for r in _records]
+    with open (fname, 'w') as f :
+        json.dump ({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
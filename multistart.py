@@ -0,0 +1,132 @@
+"""
+Parallel multi-start driver of the start vector optimizations. The random
+starts of all the points of the chromosome x tau x {contacts, diffusion} grid
+run concurrently in a process pool. The workers open the precomputed A_tau
+matrices as memory maps, so that the matrices are shared through the page
+cache instead of being pickled to each worker, and the remaining starts of a
+grid point are skipped as soon as one of its starts reaches the target value.
+"""
+import numpy as np
+import os, itertools, multiprocessing
+from .read_data import load_A_tau, tau_values
+from .sims import get_rng, optimize_start_contacts, optimize_start_diffusion
+from .messages import log_message, warn_message
+
+# state of the worker processes
+_worker = {}
+
+def _init_worker (stop, data) :
+    _worker ['stop'] = stop
+    _worker ['data'] = data
+    _worker ['matrices'] = {}
+
+def predicted_signal (x, A, what, mask=None) :
+    """
+    Returns the log2 profile predicted by the start vector x. The bins that
+    receive nothing (the zero rows of the Hi-C matrix), and those outside of
+    mask if it is given, are NaN
+    """
+    if what == 'contacts' :
+        xA = np.dot (A, x.astype (A.dtype))
+    else :
+        xA = np.dot (x.astype (A.dtype), A)
+    xA = xA.astype (np.float64)
+    valid = xA > 0.
+    if mask is not None :
+        valid = np.logical_and (valid, mask)
+    with np.errstate (divide='ignore', invalid='ignore') :
+        return np.where (valid, np.log2 (xA/np.mean (xA)), np.nan)
+
+def _run_start (task) :
+    key, seed, method, maxiter = task
+    name, tau, what = key
+    if _worker ['stop'] [key].is_set () :
+        return key, None
+    matrices = _worker ['matrices']
+    if (name, tau) not in matrices :
+        matrices [(name, tau)] = load_A_tau (name, tau, mmap_mode='r')
+    A = matrices [(name, tau)]
+    expr, mask = _worker ['data'] [name]
+    xstart = get_rng (seed).random_sample (A.shape [0])
+    xstart /= np.sum (xstart)
+    if what == 'contacts' :
+        optimize = optimize_start_contacts
+    elif what == 'diffusion' :
+        optimize = optimize_start_diffusion
+    else :
+        raise ValueError ("Unknown optimization %s" % what)
+    res = optimize (xstart, A, expr, mask, disp=False, method=method, maxiter=maxiter)
+    ok = bool (res.success) and np.isfinite (res.fun)
+    return key, (res.fun, res.x, predicted_signal (res.x, A, what, mask), ok, res.message)
+
+def _rank (res) :
+    # the failed starts are kept only if no start of the grid point succeeded
+    fun, x, signal, ok, message = res
+    return (not ok, fun if np.isfinite (fun) else np.inf)
+
+def optimize_grid (chromosomes, simdir,
+                   Tau=tau_values,
+                   what=('contacts','diffusion'),
+                   nstarts=8,
+                   target_fval=None,
+                   nprocs=None,
+                   method='SLSQP',
+                   maxiter=100,
+                   seed=None) :
+    """
+    Optimize the start vectors of all the chromosomes (Chromosome objects, for
+    their expr_binned and zerorows), for all the values of tau and for all
+    the optimizations in what, each one with the matrix A_tau, using nstarts
+    random starts per grid point. The starts that fail (the optimizer does
+    not report success, or the function is not finite) are reported with a
+    warning, and kept only if all the starts of their grid point fail. The
+    best result of each grid point is written in the files
+    simdir/analysed/<chr>-<tau>-<what>-x.dat (start vector) and -best.dat
+    (predicted log2 profile, NaN at the bins outside of the mask), which are
+    read by read_data.load_optimize_results. Return the best function values.
+    """
+    data = {}
+    for chromosome in chromosomes :
+        mask = ~np.isnan (chromosome.expr_binned)
+        if chromosome.zerorows is not None :
+            mask = np.logical_and (mask, ~chromosome.zerorows)
+        data [chromosome.name] = (chromosome.expr_binned, mask)
+    keys = list (itertools.product ([c.name for c in chromosomes], Tau, what))
+    stop = dict ([(key, multiprocessing.Event ()) for key in keys])
+    rng = get_rng (seed)
+    # the first start of every grid point runs first
+    tasks = [(key, rng.randint (2**31), method, maxiter)
+             for i in range (nstarts) for key in keys]
+    best = {}
+    failed = dict ([(key, 0) for key in keys])
+    pool = multiprocessing.Pool (nprocs, initializer=_init_worker, initargs=(stop, data))
+    try :
+        for key, res in pool.imap_unordered (_run_start, tasks) :
+            if res is None :
+                continue
+            fun, x, signal, ok, message = res
+            if not ok :
+                failed [key] += 1
+                warn_message ("optimize_grid", "%s tau=%.1f %s: start failed with f=%f (%s)" %
+                              (key [0], key [1], key [2], fun, message))
+            if key not in best or _rank (res) < _rank (best [key]) :
+                best [key] = res
+            if ok and target_fval is not None and fun <= target_fval :
+                stop [key].set ()
+    finally :
+        pool.close ()
+        pool.join ()
+    outdir = "%s/analysed" % simdir
+    if not os.path.exists (outdir) :
+        os.makedirs (outdir)
+    for key in keys :
+        name, tau, w = key
+        fun, x, signal, ok, message = best [key]
+        if not ok :
+            warn_message ("optimize_grid", "%s tau=%.1f %s: all the %d starts failed" %
+                          (name, tau, w, failed [key]))
+        log_message ("optimize_grid", "%s tau=%.1f %s: f=%f (%d failed starts)" %
+                     (name, tau, w, fun, failed [key]))
+        np.savetxt ('%s/%s-%.1f-%s-x.dat' % (outdir, name, tau, w), x)
+        np.savetxt ('%s/%s-%.1f-%s-best.dat' % (outdir, name, tau, w), signal)
+    return dict ([(key, best [key] [0]) for key in keys])
@@ -0,0 +1,206 @@
+"""
+Process-parallel runner of per-chromosome pipeline stages. A stage is a
+module-level function stage (name, *args, **kwargs) that computes the result
+of one chromosome arm; run_per_chromosome runs it for all the arms in a
+process pool and collects the results in chromosome order, concatenated into
+genome-wide arrays if requested.
+
+Large read-only arrays are not pickled to the workers: the stages load the
+data of their chromosome themselves (see worker_chromosome), and other arrays
+can be written once with share_array and opened in the stages with
+shared_array.
+
+The workers are forked with the same state of the global numpy generator, so
+the stages that draw random numbers get their seed from run_per_chromosome,
+one per chromosome (see chromosome_seed).
+"""
+import numpy as np
+import os, zlib, inspect, pickle, hashlib, multiprocessing
+from .read_data import chromosome_names, load_reporters, load_genes, load_colors
+from .chromosome import Chromosome
+from .features import FeatureIndex
+from .messages import log_message
+from .data_process import row_normalize_matrix, P_hop_plus_gene, model_r2
+from .gene_expression import gene_expression_probability_matrix, always_fire
+from .sims import get_equilibrium_distribution, get_life_and_death
+
+# per-process state of the workers
+_shared = {}
+_tables = {}
+_chromosomes = {}
+
+def share_array (array, fname) :
+    """
+    Writes array to the .npy file fname, to be opened by the workers with
+    shared_array. Return fname
+    """
+    tmp = "%s.%d.tmp" % (fname, os.getpid ())
+    with open (tmp, 'wb') as f :
+        np.save (f, array)
+    os.rename (tmp, fname)
+    return fname
+
+def shared_array (fname) :
+    """
+    Returns the array written by share_array, as a read-only memory map that
+    is opened once per process
+    """
+    if fname not in _shared :
+        _shared [fname] = np.load (fname, mmap_mode='r')
+    return _shared [fname]
+
+def worker_chromosome (name) :
+    """
+    Returns the Chromosome object of the arm, built once per process from the
+    (cached) genome-wide feature tables
+    """
+    if not _tables :
+        _tables ['reporters'] = FeatureIndex (load_reporters (),pos_field='pos')
+        _tables ['genes'] = FeatureIndex (load_genes ())
+        _tables ['colors'] = FeatureIndex (load_colors ())
+    if name not in _chromosomes :
+        _chromosomes [name] = Chromosome (name,
+                                          colors=_tables ['colors'],
+                                          reporters=_tables ['reporters'],
+                                          genes=_tables ['genes'])
+    return _chromosomes [name]
+
+def stage_key (stage, args=(), kwargs=None) :
+    """
+    Returns a hash of the stage function and of its arguments. Functions
+    among the arguments, such as the firing functions, are pickled by name
+    """
+    if kwargs is None :
+        kwargs = {}
+    s = pickle.dumps ((stage.__module__, stage.__name__, tuple (args), sorted (kwargs.items ())),
+                      protocol=2)
+    return hashlib.sha1 (s).hexdigest () [:16]
+
+def chromosome_seed (seed, name) :
+    """
+    Returns the seed of the random stream of the chromosome, derived from the
+    integer seed of the run, so that the streams of different chromosomes are
+    independent
+    """
+    ss = np.random.SeedSequence (seed, spawn_key=(zlib.crc32 (name.encode ()),))
+    return int (ss.generate_state (1) [0])
+
+def _takes_seed (stage) :
+    return 'seed' in inspect.signature (stage).parameters
+
+def checkpoint_file (checkpoint_dir, label, key, name) :
+    return "%s/%s-%s-%s.pkl" % (checkpoint_dir, label, key, name)
+
+def _run_stage (task) :
+    stage, name, args, kwargs, checkpoint_dir, label, key = task
+    if 'seed' in kwargs :
+        kwargs = dict (kwargs, seed=chromosome_seed (kwargs ['seed'], name))
+    result = stage (name, *args, **kwargs)
+    if checkpoint_dir is not None :
+        fname = checkpoint_file (checkpoint_dir, label, key, name)
+        tmp = "%s.%d.tmp" % (fname, os.getpid ())
+        with open (tmp, 'wb') as f :
+            pickle.dump (result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename (tmp, fname)
+    return name, result
+
+def run_per_chromosome (stage, names=None, args=(), kwargs=None, nprocs=None,
+                        checkpoint_dir=None, label=None, concatenate=False) :
+    """
+    Runs stage (name, *args, **kwargs) for all the chromosomes in names, in a
+    pool of nprocs processes (one per chromosome by default). If
+    checkpoint_dir is given, the result of each chromosome is saved there as
+    soon as it is computed, and the chromosomes that already have a result
+    are not run again, so that an interrupted run can be resumed. The
+    checkpoints are named after label and stage_key (stage, args, kwargs), so
+    that a run with other arguments does not load them. If the stage takes a
+    seed argument, the seed in kwargs is the seed of the run (if None, it is
+    drawn from the global numpy generator, as in sims.get_rng), and each
+    chromosome gets its own seed derived from it with chromosome_seed. Return the list of the results in the order of names, or
+    their concatenation if concatenate is True.
+    """
+    if names is None :
+        names = chromosome_names
+    if kwargs is None :
+        kwargs = {}
+    if label is None :
+        label = stage.__name__
+    results = {}
+    key = None
+    if checkpoint_dir is not None :
+        if not os.path.exists (checkpoint_dir) :
+            os.makedirs (checkpoint_dir)
+        key = stage_key (stage, args, kwargs)
+        for name in names :
+            fname = checkpoint_file (checkpoint_dir, label, key, name)
+            if os.path.exists (fname) :
+                with open (fname, 'rb') as f :
+                    results [name] = pickle.load (f)
+                log_message ("run_per_chromosome", "%s: chromosome %s from checkpoint" %
+                             (label, name))
+    if 'seed' not in kwargs and _takes_seed (stage) :
+        kwargs = dict (kwargs, seed=None)
+    if 'seed' in kwargs and kwargs ['seed'] is None :
+        # drawn once in the parent, from the global generator as in get_rng
+        kwargs = dict (kwargs, seed=np.random.randint (2**31))
+    tasks = [(stage, name, args, kwargs, checkpoint_dir, label, key)
+             for name in names if name not in results]
+    if tasks :
+        if nprocs is None :
+            nprocs = min (len (tasks), multiprocessing.cpu_count ())
+        pool = multiprocessing.Pool (nprocs)
+        try :
+            for name, result in pool.imap_unordered (_run_stage, tasks) :
+                log_message ("run_per_chromosome", "%s: chromosome %s done" % (label, name))
+                results [name] = result
+        finally :
+            pool.close ()
+            pool.join ()
+    results = [results [name] for name in names]
+    if concatenate :
+        return np.concatenate (results)
+    return results
+
+# stages
+
+def hop_gene_matrices (name, p_firing=0., firing=(always_fire,None)) :
+    """
+    Returns the row-normalized Hi-C matrix of the chromosome, mixed with the
+    gene matrix if p_firing is not zero, and the gene matrix
+    """
+    chromosome = worker_chromosome (name)
+    chromosome.init_hic ()
+    P = row_normalize_matrix (chromosome.H)
+    P_gene = gene_expression_probability_matrix (chromosome.N, chromosome.genes, firing,
+                                                 sparse=True)
+    if p_firing != 0. :
+        P = P_hop_plus_gene (P, P_gene, p_firing)
+    return P, P_gene
+
+def equilibrium_stage (name, p_firing=0., firing=(always_fire,None), seed=None, **kwargs) :
+    """
+    Stage computing the equilibrium distribution of the chromosome, see
+    get_equilibrium_distribution
+    """
+    P, P_gene = hop_gene_matrices (name, p_firing, firing)
+    return get_equilibrium_distribution (P, seed=seed, **kwargs)
+
+def life_and_death_stage (name, tau, where='prom', ntrials=10, p_firing=0.,
+                          firing=(always_fire,None), seed=None) :
+    """
+    Stage computing the population of the chromosome, see get_life_and_death
+    """
+    P, P_gene = hop_gene_matrices (name, p_firing, firing)
+    return get_life_and_death (P, P_gene, tau, where=where, ntrials=ntrials, seed=seed)
+
+def model_r2_stage (name, populations_file, offsets, bias=0.01) :
+    """
+    Stage computing the R2 of the chromosome, from the genome-wide population
+    written with share_array. offsets maps each chromosome to the index of
+    its first bin in the genome-wide population
+    """
+    chromosome = worker_chromosome (name)
+    population = shared_array (populations_file)
+    start = offsets [name]
+    return model_r2 (population [start:start+chromosome.N], chromosome.expr_binned,
+                     bias=bias, zerorows=chromosome.zerorows)
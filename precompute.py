@@ -0,0 +1,123 @@
+"""
+Builder of the precomputed A_tau matrices, A_tau = sum_t e^{-t/tau} P^t, where
+P is the row-normalized Hi-C matrix of a chromosome. The matrices are stored in
+read_data.P_powers_dir, in the files read by read_data.load_A_tau, and are
+described by a manifest (manifest.json) that records, for each file, the
+parameters and the version of the Hi-C matrix it was built from. A matrix is
+built again only if its inputs changed, or if the version of the store changed.
+
+The store can be built with:
+
+    python -m triplib.precompute [--tau 1 2 5 10 20] [--float64] [chromosomes]
+"""
+import numpy as np
+import os, json, argparse
+from .read_data import load_hic, hic_file, chromosome_names, tau_values, A_tau_file
+from .messages import log_message
+from .data_process import row_normalize_matrix
+from .sims import exponential_matrix_sum
+from .cache import source_key
+from . import read_data
+
+# version of the store: change it when the way the matrices are computed
+# changes, so that all of them are built again
+store_version = 1
+
+def manifest_file () :
+    return "%s/manifest.json" % read_data.P_powers_dir
+
+def load_manifest () :
+    """
+    Returns the manifest of the store, or an empty one if there is no store or
+    if it was built by a different version
+    """
+    empty = {'version' : store_version, 'entries' : {}}
+    if not os.path.exists (manifest_file ()) :
+        return empty
+    with open (manifest_file (), 'r') as f :
+        manifest = json.load (f)
+    if manifest.get ('version') != store_version :
+        return empty
+    return manifest
+
+def save_manifest (manifest) :
+    tmp = "%s.%d.tmp" % (manifest_file (), os.getpid ())
+    with open (tmp, 'w') as f :
+        json.dump (manifest, f, indent=1, sort_keys=True)
+    os.rename (tmp, manifest_file ())
+
+def entry_inputs (chromosome, tau, tol, with_identity, normalized, dtype) :
+    """
+    Returns the description of the inputs of a matrix in the store
+    """
+    return {'chromosome' : chromosome,
+            'tau' : float (tau),
+            'tol' : tol,
+            'with_identity' : with_identity,
+            'hic' : source_key (hic_file (chromosome, normalized)),
+            'dtype' : np.dtype (dtype).name}
+
+def build_A_tau_store (names=None, Tau=tau_values, tol=1e-8, with_identity=False,
+                       normalized=True, dtype=np.float32, force=False) :
+    """
+    Builds the A_tau matrices of all the chromosomes for all the values in Tau,
+    skipping the ones whose inputs are unchanged, unless force is True. The
+    matrices of a chromosome are computed together, sharing the powers of P
+    """
+    if names is None :
+        names = chromosome_names
+    if not os.path.exists (read_data.P_powers_dir) :
+        os.makedirs (read_data.P_powers_dir)
+    manifest = load_manifest ()
+    entries = manifest ['entries']
+    for name in names :
+        todo = []
+        for tau in Tau :
+            fname = os.path.basename (A_tau_file (name, tau))
+            inputs = entry_inputs (name, tau, tol, with_identity, normalized, dtype)
+            if force or entries.get (fname) != inputs or \
+               not os.path.exists (A_tau_file (name, tau)) :
+                todo.append ((tau, fname, inputs))
+        if not todo :
+            log_message ("build_A_tau_store", "Chromosome %s is up to date" % name)
+            continue
+        log_message ("build_A_tau_store", "Building chromosome %s, tau = %s" %
+                     (name, ", ".join (["%.2f" % t for t, f, i in todo])))
+        P = row_normalize_matrix (np.asarray (load_hic (name, normalized=normalized)))
+        A = exponential_matrix_sum (P, [t for t, f, i in todo],
+                                    with_identity=with_identity, tol=tol, dtype=dtype)
+        del P
+        for (tau, fname, inputs), A_tau in zip (todo, A) :
+            tmp = "%s.%d.tmp" % (A_tau_file (name, tau), os.getpid ())
+            with open (tmp, 'wb') as f :
+                np.save (f, A_tau)
+            os.rename (tmp, A_tau_file (name, tau))
+            entries [fname] = inputs
+        del A
+        # save after each chromosome, so that an interrupted build can resume
+        save_manifest (manifest)
+    return manifest
+
+def main () :
+    parser = argparse.ArgumentParser (description="Build the store of the A_tau matrices")
+    parser.add_argument ("chromosomes", nargs='*', help="chromosomes to build (default: all)")
+    parser.add_argument ("--tau", type=float, nargs='+', default=tau_values,
+                         help="values of tau")
+    parser.add_argument ("--tol", type=float, default=1e-8,
+                         help="tolerance of the truncation of the sums")
+    parser.add_argument ("--with-identity", action='store_true',
+                         help="include the t=0 term in the sums")
+    parser.add_argument ("--raw", action='store_true', help="use the non-normalized Hi-C matrices")
+    parser.add_argument ("--float64", action='store_true', help="store in double precision")
+    parser.add_argument ("--force", action='store_true', help="build all the matrices again")
+    args = parser.parse_args ()
+    build_A_tau_store (args.chromosomes if args.chromosomes else None,
+                       Tau=args.tau,
+                       tol=args.tol,
+                       with_identity=args.with_identity,
+                       normalized=not args.raw,
+                       dtype=np.float64 if args.float64 else np.float32,
+                       force=args.force)
+
+if __name__ == '__main__' :
+    main ()
@@ -0,0 +1,207 @@
+"""
+Multi-resolution pyramid of a chromosome, and coarse-to-fine optimization of
+the start vectors. The coarse levels aggregate factor consecutive bins of the
+Hi-C resolution (2 kb by default) into one: the Hi-C and gene matrices are
+summed over blocks, a coarse bin is a zero row if all its bins are, and the
+binned expression is recomputed from the reporters at the coarse resolution
+(or averaged over the bins if the reporters are not available).
+
+The optimization is solved at the coarsest level first, from random starts,
+and the solution of each level, prolonged to the next finer level, is the
+start vector there, so that the full resolution starts close to the optimum.
+The matrix A_tau of a coarse level is the one of the full resolution averaged
+over blocks, so that the coarse problem is the full one restricted to start
+vectors that are constant over the blocks.
+"""
+import numpy as np
+import scipy.sparse
+from .read_data import load_expr_binned
+from .messages import log_message
+from .data_process import row_normalize_matrix
+from .gene_expression import gene_expression_probability_matrix
+from .sims import get_rng, exponential_matrix_sum, optimize_start_contacts, \
+    optimize_start_diffusion
+from .instrument import span, add_count
+
+def coarse_size (N, factor) :
+    return -(-N//factor)
+
+def block_starts (N, factor) :
+    """
+    Returns the first bin of each block of factor bins, and the number of bins
+    of each block (the last one can be shorter)
+    """
+    starts = np.arange (0, N, factor)
+    return starts, np.diff (np.append (starts, N))
+
+def coarsen_matrix (M, factor) :
+    """
+    Returns the dense or sparse square matrix M summed over blocks of
+    factor*factor bins. Sparse matrices are returned in CSR format
+    """
+    N = M.shape [0]
+    if scipy.sparse.issparse (M) :
+        R = scipy.sparse.csr_matrix ((np.ones (N), (np.arange (N)//factor, np.arange (N))),
+                                     shape=(coarse_size (N, factor), N))
+        return R.dot (M).dot (R.T).tocsr ()
+    starts, counts = block_starts (N, factor)
+    return np.add.reduceat (np.add.reduceat (M, starts, axis=0), starts, axis=1)
+
+def coarsen_zerorows (zerorows, factor) :
+    """
+    Returns the zerorows mask of the coarse bins: a coarse bin is empty if
+    all its bins are
+    """
+    starts, counts = block_starts (len (zerorows), factor)
+    return np.logical_and.reduceat (np.asarray (zerorows, dtype=bool), starts)
+
+def coarsen_expr (expr_binned, factor) :
+    """
+    Returns the binned expression averaged over blocks of factor bins,
+    ignoring the NaN bins. A coarse bin with only NaN bins is NaN
+    """
+    starts, counts = block_starts (len (expr_binned), factor)
+    valid = ~np.isnan (expr_binned)
+    total = np.add.reduceat (np.where (valid, expr_binned, 0.), starts)
+    n = np.add.reduceat (valid.astype (float), starts)
+    with np.errstate (invalid='ignore') :
+        return total/n
+
+def coarsen_operator (A, factor) :
+    """
+    Returns the dense matrix A averaged over blocks of factor*factor bins: for
+    a start vector constant over the blocks, the average over the blocks of
+    x A is the coarse start vector times the coarse matrix
+    """
+    starts, counts = block_starts (A.shape [0], factor)
+    C = coarsen_matrix (A, factor)
+    if scipy.sparse.issparse (C) :
+        C = C.toarray ()
+    return C/np.outer (counts, counts)
+
+def prolong (x, factor, N, mix=0.) :
+    """
+    Returns the start vector x of a coarse level as a start vector of the
+    N bins of the finer level, factor times finer: the weight of each coarse
+    bin is shared equally by its bins, and the result sums to one. The result
+    is mixed with the uniform vector with weight mix
+    """
+    starts, counts = block_starts (N, factor)
+    xf = np.repeat (np.asarray (x, dtype=float)/counts, counts)
+    return (1.-mix)*xf/np.sum (xf) + mix/N
+
+class PyramidLevel :
+    """
+    The data of a chromosome at one level of the pyramid, factor times
+    coarser than the Hi-C resolution: N, H, zerorows, expr_binned and the gene
+    matrix P_gene (None if no firing function was given)
+    """
+    def __init__ (self, factor, hic_res, H, zerorows, expr_binned, P_gene=None) :
+        self.factor = factor
+        self.hic_res = hic_res
+        self.N = H.shape [0]
+        self.H = H
+        self.zerorows = zerorows
+        self.expr_binned = expr_binned
+        self.P_gene = P_gene
+    def mask (self) :
+        """
+        Returns the mask of the bins with a valid expression
+        """
+        mask = ~np.isnan (self.expr_binned)
+        if self.zerorows is not None :
+            mask = np.logical_and (mask, ~self.zerorows)
+        return mask
+
+@span ("resolution_pyramid")
+def resolution_pyramid (chromosome, factors=(1,2,4,8), hic_res=2000, firing=None) :
+    """
+    Returns the levels of the pyramid of the chromosome (a Chromosome object),
+    one PyramidLevel per factor, from the finest to the coarsest. With
+    hic_res=2000, the default factors give the resolutions 2, 4, 8 and 16 kb.
+    If firing is given, the gene matrix of each level is computed too, see
+    gene_expression_probability_matrix
+    """
+    H = chromosome.H
+    N = H.shape [0]
+    zerorows = chromosome.zerorows
+    if zerorows is None :
+        zerorows = np.zeros (N, dtype=bool)
+    P_gene = None
+    if firing is not None :
+        P_gene = gene_expression_probability_matrix (N, chromosome.genes, firing, hic_res,
+                                                     sparse=True)
+    levels = []
+    for factor in factors :
+        if factor == 1 :
+            levels.append (PyramidLevel (1, hic_res, H, zerorows, chromosome.expr_binned, P_gene))
+            continue
+        if chromosome.reporters is not None :
+            expr = load_expr_binned (chromosome.reporters, coarse_size (N, factor),
+                                     hic_res=hic_res*factor)
+        else :
+            expr = coarsen_expr (chromosome.expr_binned, factor)
+        levels.append (PyramidLevel (factor, hic_res*factor,
+                                     coarsen_matrix (H, factor),
+                                     coarsen_zerorows (zerorows, factor),
+                                     expr,
+                                     None if P_gene is None else coarsen_matrix (P_gene, factor)))
+    return levels
+
+@span ("optimize_coarse_to_fine")
+def optimize_coarse_to_fine (levels, tau=None, what='diffusion', A=None,
+                             nstarts=1, with_identity=False, disp=False,
+                             method='SLSQP', maxiter=100, seed=None, mix=0.1) :
+    """
+    Optimize the start vector of the finest level of the pyramid levels (as
+    returned by resolution_pyramid), starting from the coarsest one. A is the
+    matrix A_tau of the finest level, e.g. the precomputed one from
+    read_data.load_A_tau; if it is not given, it is computed from the H of
+    the finest level and tau. The matrices of the coarse levels are obtained
+    from it with coarsen_operator. The coarsest level is solved from nstarts
+    random starts, and each finer level from the prolonged solution of the
+    coarser one, mixed with the uniform vector with weight mix, so that no bin
+    starts at zero, where the optimizers tend to keep it. Return the result of
+    the finest level, and the list of the results of all the levels
+    """
+    if what == 'contacts' :
+        optimize = optimize_start_contacts
+    elif what == 'diffusion' :
+        optimize = optimize_start_diffusion
+    else :
+        raise ValueError ("Unknown optimization %s" % what)
+    factors = [level.factor for level in levels]
+    for fine, coarse in zip (factors [:-1], factors [1:]) :
+        if coarse % fine != 0 :
+            raise ValueError ("Factor %d is not a multiple of factor %d" % (coarse, fine))
+    if A is None :
+        A = exponential_matrix_sum (row_normalize_matrix (levels [0].H), tau,
+                                    with_identity=with_identity)
+    rng = get_rng (seed)
+    results = [None]*len (levels)
+    x = None
+    for k in range (len (levels)-1, -1, -1) :
+        level = levels [k]
+        factor = level.factor//levels [0].factor
+        Ak = A if factor == 1 else coarsen_operator (A, factor)
+        expr = level.expr_binned
+        mask = level.mask ()
+        if x is None :
+            # coarsest level: random starts
+            best = None
+            for s in range (nstarts) :
+                xstart = rng.random_sample (level.N)
+                xstart /= np.sum (xstart)
+                res = optimize (xstart, Ak, expr, mask, disp=disp, method=method, maxiter=maxiter)
+                if best is None or res.fun < best.fun :
+                    best = res
+            res = best
+        else :
+            xstart = prolong (x, levels [k+1].factor//level.factor, level.N, mix)
+            res = optimize (xstart, Ak, expr, mask, disp=disp, method=method, maxiter=maxiter)
+        log_message ("optimize_coarse_to_fine", "%d kb: f = %g after %d iterations" %
+                     (level.hic_res//1000, res.fun, res.get ('nit', 0)))
+        add_count ("levels")
+        results [k] = res
+        x = res.x
+    return results [0], results
@@ -1,6 +1,11 @@
 import numpy as np
 import os, gzip
-from .data_process import warn_message
+import scipy.sparse
+from .messages import warn_message
+from .data_process import band_matrix
+from .cache import load_cached, LRUCache
+from .binning import bin_index, in_range, field_isin
+from .instrument import span, add_count
 
 # module-wide variables
 base_datadir = os.getenv ("HOME") + "/work/data/"
@@ -15,66 +20,237 @@ P_powers_dir = os.getenv ("HOME") + "/work/data/tripsims/P_powers"
 chr_N_dir = os.getenv ("HOME") + "/work/data/tripsims/chr_N"
 zerolines_dir = os.getenv ("HOME") + "/work/data/tripsims/zerorows"
 DAMid_file = base_datadir + "drosophila_DAMid.txt.gz"
+chromosome_names = ['2L','2R','3L','3R','X']
+tau_values = [1.0,2.0,5.0,10.0,20.0]
 
-# load hi-c data
-def load_hic (chromosome, normalized=True) :
+def hic_file (chromosome, normalized=True) :
+    """
+    Returns the file of the Hi-C matrix of the chromosome
+    """
     if normalized :
-        return np.loadtxt ("%s/%s_norm.mat.gz"%(hic_datadir,chromosome))
+        return "%s/%s_norm.mat.gz"%(hic_datadir,chromosome)
     else :
-        return np.loadtxt ("%s/%s.mat.gz"%(hic_datadir,chromosome))
+        return "%s/%s.mat.gz"%(hic_datadir,chromosome)
+
+# load hi-c data
+@span ("load_hic")
+def load_hic (chromosome, normalized=True, sparse=False, max_distance=None,
+              cache=False, mmap_mode=None) :
+    """
+    Load the Hi-C matrix of the chromosome. If sparse is True, the matrix is
+    returned in CSR format, without ever building the dense matrix. If
+    max_distance is given, only the entries within max_distance bins from the
+    diagonal are kept. If cache is True, the matrix is parsed only once and
+    then read from the binary cache (written in cache.cache_dir). Dense
+    matrices are then read in memory, or opened as memory maps if mmap_mode is
+    given: use mmap_mode='r' to share the pages among processes, the matrix
+    being read-only
+    """
+    fname = hic_file (chromosome, normalized)
+    if cache :
+        tag = "sparse" if sparse else "dense"
+        if max_distance is not None :
+            tag += "-d%d" % max_distance
+        return load_cached (fname,
+                            lambda : load_hic (chromosome, normalized=normalized,
+                                               sparse=sparse,
+                                               max_distance=max_distance,
+                                               cache=False),
+                            tag=tag, sparse=sparse, mmap_mode=mmap_mode)
+    if sparse :
+        return load_hic_sparse (fname, max_distance=max_distance)
+    H = np.loadtxt (fname)
+    if max_distance is not None :
+        H = band_matrix (H, max_distance)
+    return H
+
+# Hi-C matrices in memory, shared by all the Chromosome objects of the process.
+# By default, only the matrix of one arm is kept
+hic_cache = LRUCache (max_items=1)
+
+def set_hic_cache_budget (max_items=None, max_bytes=None) :
+    """
+    Sets the maximum number of Hi-C matrices, and of bytes, kept in memory by
+    get_hic (None meaning no limit). The default budget is a single matrix:
+    a loop over the arms then holds one matrix at a time, and going back to
+    an arm loads its matrix again (from the binary cache). With max_bytes
+    only, as many matrices as fit are kept, but always at least the last one,
+    e.g. set_hic_cache_budget (max_bytes=4*2**30) for 4 GB
+    """
+    hic_cache.set_budget (max_items=max_items, max_bytes=max_bytes)
+
+def get_hic (chromosome, normalized=True, sparse=False, max_distance=None, mmap_mode=None) :
+    """
+    Same as load_hic with the binary cache, but keeping the most recently used
+    matrices in memory (see set_hic_cache_budget). The matrices are writable,
+    unless mmap_mode is given
+    """
+    key = (chromosome, normalized, sparse, max_distance, mmap_mode)
+    return hic_cache.get (key, lambda : load_hic (chromosome, normalized=normalized,
+                                                  sparse=sparse,
+                                                  max_distance=max_distance,
+                                                  cache=True, mmap_mode=mmap_mode))
+
+def load_hic_sparse (fname, max_distance=None) :
+    """
+    Load a text Hi-C matrix row by row into a CSR matrix, keeping only the
+    nonzero entries (within max_distance bins from the diagonal, if given)
+    """
+    indptr = [0]
+    indices = []
+    data = []
+    with gzip.open (fname, 'rt') as f :
+        for i, line in enumerate (f) :
+            row = np.array (line.split (), dtype=np.float64)
+            if max_distance is not None :
+                n1 = max (0, i-max_distance)
+                cols = n1 + np.nonzero (row [n1:i+max_distance+1]) [0]
+            else :
+                cols = np.nonzero (row) [0]
+            indices.append (cols.astype (np.int32))
+            data.append (row [cols])
+            indptr.append (indptr [-1] + len (cols))
+    N = len (indptr)-1
+    return scipy.sparse.csr_matrix ((np.concatenate (data),
+                                     np.concatenate (indices),
+                                     np.array (indptr)),
+                                    shape=(N,N))
 
 
+def read_lines (fname, header=False) :
+    """
+    Returns the lines of the text file fname (gzipped if its name ends with
+    .gz), without comments (starting with '#') and empty lines. If header is
+    True, the first line of the file is the header, even if it starts with
+    '#', and the header and the other lines are returned
+    """
+    opener = gzip.open if fname.endswith ('.gz') else open
+    with opener (fname, 'rt') as f :
+        lines = f.read ().splitlines ()
+    first = None
+    if header :
+        first, lines = (lines [0] if lines else ''), lines [1:]
+    lines = [l for l in lines if l.strip () and l.lstrip () [0] != '#']
+    if header :
+        return first, lines
+    return lines
+
+def _convert (values, fmt) :
+    """
+    Converts a list of strings to an array of type fmt, in a single vectorized
+    conversion when possible. Values that can not be converted become nan for
+    floats and -1 for integers, as with np.genfromtxt
+    """
+    try :
+        return np.array (values).astype (fmt)
+    except ValueError :
+        kind = np.dtype (fmt).kind
+        conv = float if kind == 'f' else int
+        missing = np.nan if kind == 'f' else -1
+        out = np.empty (len (values), dtype=fmt)
+        for k, v in enumerate (values) :
+            try :
+                out [k] = conv (v)
+            except ValueError :
+                out [k] = missing
+        return out
+
+def parse_table (lines, dtype, usecols=None, fields=None) :
+    """
+    Parses whitespace-separated lines into a structured array of type dtype,
+    converting one column at a time. usecols gives the column of each field of
+    dtype, and fields selects the fields to load (default: all)
+    """
+    dtype = np.dtype (dtype)
+    if usecols is None :
+        usecols = range (len (dtype.names))
+    if fields is None :
+        fields = dtype.names
+    rows = [l.split () for l in lines]
+    out = np.empty (len (rows), dtype=[(name, dtype [name]) for name in fields])
+    for name, col in zip (dtype.names, usecols) :
+        if name in fields :
+            out [name] = _convert ([row [col] for row in rows], dtype [name])
+    return out
+
+# version of the parsing of the tables, part of the names of their cache
+# files: increase it when the parsing changes, so that the tables are parsed
+# again
+table_version = 2
+
+def load_table (source, name, build, fields=None, cache=True) :
+    """
+    Returns the table parsed from source by the function build, using the
+    binary cache (see cache.load_cached) if cache is True
+    """
+    if not cache :
+        return build ()
+    tag = "%s%d" % (name, table_version)
+    if fields is not None :
+        tag = "%s-%s" % (tag, "-".join (fields))
+    return load_cached (source, build, tag=tag, mmap_mode=None)
+
+# types of the gene table, and of the first columns of the reporter table (the
+# further columns of the reporter table are floats)
+gene_dtype = {'names' : ['chr','start','end','strand','expr','color','gene','state9'],
+              'formats' : ['S10','i8','i8','S2','f','S10','S10','i4']}
+reporter_formats = ['S30','S8','S2','i8','f','S4','i2']
+
 # load the gene data
-def load_genes () :
-    gene_dtype = {'names' : ['chr','start','end','strand','expr','color','gene','state9'],
-                             'formats' : ['S10','i8','i8','S2','f','S10','S10','i4']}
-    return np.genfromtxt (gene_file, dtype=np.dtype (gene_dtype), skip_header=1)
+@span ("load_genes")
+def load_genes (fields=None, cache=True) :
+    build = lambda : parse_table (read_lines (gene_file, header=True) [1], gene_dtype,
+                                  fields=fields)
+    return load_table (gene_file, 'genes', build, fields, cache)
 
 # load _active_ genes
-def load_active_genes () :
+@span ("load_active_genes")
+def load_active_genes (fields=None, cache=True) :
     activegene_dtype = {'names' : ['chr','start','end','strand'],
                         'formats' : ['S10','i8','i8','S2']}
-    return np.genfromtxt (activegene_file, dtype=np.dtype (activegene_dtype),
-                          skip_header=1,usecols=(0,1,2,4))
+    build = lambda : parse_table (read_lines (activegene_file, header=True) [1],
+                                  activegene_dtype, usecols=(0,1,2,4), fields=fields)
+    return load_table (activegene_file, 'active_genes', build, fields, cache)
 
 # load the colors data
-def load_colors () :
+@span ("load_colors")
+def load_colors (fields=None, cache=True) :
     colors_dtype = {'names' : ['chr','start','end','color','size'],
                              'formats' : ['S10','i8','i8','S8','i8']}
-    return np.genfromtxt (colors_file, dtype=np.dtype (colors_dtype))
+    build = lambda : parse_table (read_lines (colors_file), colors_dtype, fields=fields)
+    return load_table (colors_file, 'colors', build, fields, cache)
 
 # load the reporter data
-def load_reporters () :
-    with open (reporter_file, 'r') as f :
-        for line in f :
-            if line [0] == '#' :
-                continue
-            break
-    keys = line.strip ('\n').split ()
-    types = ['S30','S8','S2','i8','f','S4','i2']
-    for i in range (len (types), len (keys)) :
-        types.append ('f')
-    reporter_dtype = {'names' : keys, 'formats' : types}
-    return np.genfromtxt (reporter_file, dtype=np.dtype (reporter_dtype), skip_header=6)
+@span ("load_reporters")
+def load_reporters (fields=None, cache=True) :
+    def build () :
+        # the header follows the comments at the top of the file: it is the
+        # first line that is not a comment
+        lines = read_lines (reporter_file)
+        keys = lines [0].split ()
+        types = list (reporter_formats)
+        for i in range (len (types), len (keys)) :
+            types.append ('f')
+        reporter_dtype = {'names' : keys, 'formats' : types}
+        return parse_table (lines [1:], reporter_dtype, fields=fields)
+    return load_table (reporter_file, 'reporters', build, fields, cache)
 
 # get hic-binned average reporter expression
+@span ("load_expr_binned")
 def load_expr_binned (reporters, nsites,
                       responsive = ['pI','pII','pIII','pIV'],
                       hic_res=2000,
                       substitute_nans=False) :
-    expr_binned = np.zeros (nsites)
-    n_reporters = np.zeros (nsites)
-    for r in reporters :
-        prom = r['prom']
-        if prom != 'p0' and prom in responsive : 
-            pos = r['pos']
-            i = pos/hic_res
-            try :
-                expr_binned [i] += r['nexp']
-                n_reporters [i] += 1.
-            except IndexError :
-                warn_message ("load_expr_binned", "Index %d out of range"%i)
-                continue
+    prom = reporters['prom']
+    selected = np.logical_and (field_isin (prom, responsive), ~field_isin (prom, ['p0']))
+    i = bin_index (reporters['pos'][selected], hic_res)
+    valid = in_range (i, nsites, "load_expr_binned")
+    add_count ("reporters", len (valid))
+    add_count ("out_of_range", len (valid)-np.count_nonzero (valid))
+    i = i [valid]
+    nexp = np.asarray (reporters['nexp'][selected][valid], dtype=float)
+    expr_binned = np.bincount (i, weights=nexp, minlength=nsites)
+    n_reporters = np.bincount (i, minlength=nsites).astype (float)
     # calculate the average per bin
     with np.errstate (invalid='ignore') :
         expr_binned/=n_reporters
@@ -82,64 +258,94 @@ def load_expr_binned (reporters, nsites,
         expr_binned [np.isnan (expr_binned)] = 0.
     return expr_binned
 
-def load_P_powers (chromosome) :
-    return np.load ("%s/%s.npy" % (P_powers_dir,chromosome))
+def load_P_powers (chromosome, mmap_mode=None) :
+    return np.load ("%s/%s.npy" % (P_powers_dir,chromosome), mmap_mode=mmap_mode)
 
-def load_A_tau (chromosome, tau) :
-    return np.load ("%s/%s-A-%.2f.npy" % (P_powers_dir,chromosome,tau))
+def A_tau_file (chromosome, tau) :
+    return "%s/%s-A-%.2f.npy" % (P_powers_dir,chromosome,tau)
+
+@span ("load_A_tau")
+def load_A_tau (chromosome, tau, mmap_mode=None) :
+    """
+    Load the precomputed matrix A_tau of the chromosome (see precompute). Use
+    mmap_mode='r' to share the matrix among processes
+    """
+    return np.load (A_tau_file (chromosome, tau), mmap_mode=mmap_mode)
+
+def transition_sampler_file (chromosome, label='P') :
+    """
+    Returns the file where the TransitionSampler of the matrix identified by
+    label is stored for the chromosome specified
+    """
+    return "%s/%s-%s-sampler.npz" % (P_powers_dir,chromosome,label)
+
+# per-chromosome metadata, loaded once per process
+_chromosome_N = {}
+_chromosome_zerorows = {}
 
 def chromosome_N (chromosome) :
     """
     Returns the number of bins in the chromosome specified
     """
-    n = np.loadtxt ("%s/%s.dat" % (chr_N_dir,chromosome),dtype=np.int32)
-    return int (n)
+    if chromosome not in _chromosome_N :
+        n = np.loadtxt ("%s/%s.dat" % (chr_N_dir,chromosome),dtype=np.int32)
+        _chromosome_N [chromosome] = int (n)
+    return _chromosome_N [chromosome]
 
 def chromosome_zerorows (chromosome) :
     """
     Returns an array of boolean values telling whether the corresponding
-    row/column in the Hi-C matrix is considered null
-    """
-    zerolines = np.loadtxt ("%s/%s-zerorows.dat" % (zerolines_dir,chromosome),
-                            dtype=np.int32)
-    N = chromosome_N (chromosome)
-    z = np.zeros (N, dtype=bool)
-    z [zerolines] = True
-    return z
-
-def load_DAMid () :
-    with gzip.open (DAMid_file,'r') as f :
-        line = f.readline ()
-    header = line.strip('\n').split('\t')
-    keys = ['fragmentID','chr','start','end']
-    types = ['S30','S8','i8','i8']
-    for i in range ((len(types)),len(header)) :
-        types.append ('f')
-        keys.append (header[i])
-    DAMid_dtype = {'names' : keys, 'formats' : types}
-    DAMid = np.genfromtxt (DAMid_file, dtype=np.dtype(DAMid_dtype),skip_header=1)
-    for d in DAMid :
-        d['chr'] = d['chr'].strip('chr')
-    return DAMid
-
-def load_optimize_results (simdir,what,Tau=[1.0,2.0,5.0,10.0,20.0]) :
+    row/column in the Hi-C matrix is considered null. The array is shared by
+    all the callers and must not be modified
+    """
+    if chromosome not in _chromosome_zerorows :
+        zerolines = np.loadtxt ("%s/%s-zerorows.dat" % (zerolines_dir,chromosome),
+                                dtype=np.int32)
+        N = chromosome_N (chromosome)
+        z = np.zeros (N, dtype=bool)
+        z [zerolines] = True
+        z.flags.writeable = False
+        _chromosome_zerorows [chromosome] = z
+    return _chromosome_zerorows [chromosome]
+
+@span ("load_DAMid")
+def load_DAMid (fields=None, cache=True) :
+    def build () :
+        header, lines = read_lines (DAMid_file, header=True)
+        header = header.split ('\t')
+        keys = ['fragmentID','chr','start','end']
+        types = ['S30','S8','i8','i8']
+        for i in range ((len(types)),len(header)) :
+            types.append ('f')
+            keys.append (header[i])
+        DAMid_dtype = {'names' : keys, 'formats' : types}
+        DAMid = parse_table (lines, DAMid_dtype, fields=fields)
+        if 'chr' in DAMid.dtype.names :
+            DAMid['chr'] = np.char.strip (DAMid['chr'], b'chr')
+        return DAMid
+    return load_table (DAMid_file, 'DAMid', build, fields, cache)
+
+@span ("load_optimize_results")
+def load_optimize_results (simdir,what,Tau=tau_values,names=chromosome_names) :
     """
     Loads the results of an optimization run, taking into account directory
-    specification and 'what' specification.
+    specification and 'what' specification. Return the genome-wide start
+    vectors and predicted signals, one row per value of tau.
     """
     if not os.path.exists (simdir) :
-        raise ValueError
+        raise ValueError ("%s does not exist" % simdir)
     final_x = []
     final_signal = []
-    for Tau in Tauvals :
+    for tau in Tau :
         x = np.empty(0)
         signal = np.empty(0)
-        for chromosome in chromosomes :
-            f = '%s/analysed/%s-%.1f-%s-x.dat'%(random_datadir,chromosome.name,Tau,what)
+        for name in names :
+            f = '%s/analysed/%s-%.1f-%s-x.dat'%(simdir,name,tau,what)
             x = np.concatenate((x,np.loadtxt (f)))
-            f = '%s/analysed/%s-%.1f-%s-best.dat'%(random_datadir,chromosome.name,Tau,what)
+            f = '%s/analysed/%s-%.1f-%s-best.dat'%(simdir,name,tau,what)
             signal = np.concatenate((signal,np.loadtxt (f)))
         final_x.append (x)
-        final_signal.append (x)
-    final_x = np.array (final_x) 
-    final_signal = np.array (final_signal) 
+        final_signal.append (signal)
+    final_x = np.array (final_x)
+    final_signal = np.array (final_signal)
+    return final_x, final_signal
@@ -1,6 +1,8 @@
 import numpy as np
-from scipy.sparse.linalg import eigs
-from scipy.optimize      import minimize
+import os, hashlib, weakref
+import scipy.sparse
+from .data_process import HopGeneMixer
+from .instrument import span, add_count
 
 def jump_to (p):
     """
@@ -9,6 +11,221 @@ def jump_to (p):
     value = np.random.random ()
     return np.argmax (value-p<0.)
 
+def get_rng (seed=None) :
+    """
+    Return a RandomState for the given seed. If seed is None, the stream is
+    seeded from the global numpy generator, so that np.random.seed still makes
+    the simulations reproducible. A RandomState passed as seed is returned as is
+    """
+    if isinstance (seed, np.random.RandomState) :
+        return seed
+    if seed is None :
+        seed = np.random.randint (2**31)
+    return np.random.RandomState (seed)
+
+def jump_many (Pn, rows, u) :
+    """
+    Vectorized version of jump_to: for each walker sitting at a site in rows,
+    select the next site from the cumulative probability matrix Pn, given the
+    random numbers u. The lookup is a binary search done on all walkers at once
+    """
+    nsites = Pn.shape [1]
+    lo = np.zeros (len (rows), dtype=np.intp)
+    hi = np.full (len (rows), nsites, dtype=np.intp)
+    for k in range (int (np.ceil (np.log2 (nsites+1)))) :
+        searching = lo < hi
+        mid = (lo+hi)//2
+        right = Pn [rows, np.minimum (mid, nsites-1)] <= u
+        lo = np.where (searching & right, mid+1, lo)
+        hi = np.where (searching & ~right, mid, hi)
+    # same as jump_to: if no site is found, go to the first one
+    lo [lo==nsites] = 0
+    return lo
+
+class TransitionSampler :
+    """
+    Sampling index of a transition matrix P, that does not change during a
+    simulation. For each row, only the cumulative probabilities of the nonzero
+    entries are stored, in CSR layout, so that each jump costs O(log nnz) of
+    the row instead of O(nsites).
+    """
+    def __init__ (self, indptr, indices, cdf, shape, key=None) :
+        self.indptr = indptr
+        self.indices = indices
+        self.cdf = cdf
+        self.shape = shape
+        self.key = key
+        counts = np.diff (indptr)
+        self.maxnnz = int (counts.max ()) if len (counts) > 0 else 0
+    @classmethod
+    def from_matrix (cls, P, key=None, block_size=256) :
+        """
+        Build the sampling index of the dense or sparse matrix P
+        """
+        nsites = P.shape [0]
+        if scipy.sparse.issparse (P) :
+            P = scipy.sparse.csr_matrix (P)
+            P.sum_duplicates ()
+            P.eliminate_zeros ()
+            indptr = P.indptr.astype (np.int64)
+            indices = P.indices.astype (np.int32)
+            cs = np.cumsum (P.data, dtype=np.float64)
+            # subtract the cumulative sum of the previous rows
+            offset = np.concatenate (([0.], cs)) [indptr [:-1]]
+            cdf = cs - np.repeat (offset, np.diff (indptr))
+        else :
+            counts = np.zeros (nsites, dtype=np.int64)
+            indices = []
+            cdf = []
+            # work on blocks of rows, to avoid N*N temporaries
+            for n1 in range (0, nsites, block_size) :
+                block = np.asarray (P [n1:n1+block_size], dtype=np.float64)
+                nonzero = block != 0.
+                counts [n1:n1+block_size] = np.sum (nonzero, axis=1)
+                indices.append (np.nonzero (nonzero) [1].astype (np.int32))
+                cdf.append (np.cumsum (block, axis=1) [nonzero])
+            indptr = np.concatenate (([0], np.cumsum (counts)))
+            indices = np.concatenate (indices)
+            cdf = np.concatenate (cdf)
+        return cls (indptr, indices, cdf, P.shape, key=key)
+    def jump (self, rows, u) :
+        """
+        Same as jump_many, but using the sampling index
+        """
+        lo = self.indptr [rows]
+        end = self.indptr [rows+1]
+        hi = end.copy ()
+        for k in range (int (np.ceil (np.log2 (self.maxnnz+1)))) :
+            searching = lo < hi
+            mid = (lo+hi)//2
+            right = self.cdf [np.minimum (mid, len (self.cdf)-1)] <= u
+            lo = np.where (searching & right, mid+1, lo)
+            hi = np.where (searching & ~right, mid, hi)
+        # same as jump_to: if no site is found, go to the first one
+        found = lo < end
+        sites = np.zeros (len (rows), dtype=np.intp)
+        sites [found] = self.indices [lo [found]]
+        return sites
+    def save (self, fname) :
+        np.savez (fname,
+                  indptr=self.indptr,
+                  indices=self.indices,
+                  cdf=self.cdf,
+                  shape=np.array (self.shape),
+                  key=np.array (self.key if self.key is not None else ''))
+    @classmethod
+    def load (cls, fname) :
+        with np.load (fname) as f :
+            key = str (f['key'])
+            return cls (f['indptr'], f['indices'], f['cdf'], tuple (f['shape']),
+                        key=key if key else None)
+
+def matrix_hash (P) :
+    """
+    Returns a hash of the content of the dense or sparse matrix P
+    """
+    h = hashlib.sha1 ()
+    h.update (str (P.shape).encode ())
+    if scipy.sparse.issparse (P) :
+        P = scipy.sparse.csr_matrix (P)
+        arrays = [P.indptr, P.indices, P.data]
+    else :
+        arrays = [P]
+    for a in arrays :
+        a = np.ascontiguousarray (a)
+        h.update (str (a.dtype).encode ())
+        h.update (a.view (np.uint8).reshape (-1))
+    return h.hexdigest ()
+
+# samplers built in this process, indexed by the key given by the caller, or
+# by the identity of their matrix (with a weak reference to check it)
+_samplers = {}
+_samplers_maxsize = 4
+
+def get_transition_sampler (P, cache_file=None, key=None) :
+    """
+    Returns the TransitionSampler of the matrix P. The sampler is built only
+    once per matrix and kept in memory, identified by key if it is given (e.g.
+    the chromosome and the parameters of P), otherwise by the matrix object
+    itself, which must then not be modified in place. If cache_file is given,
+    the sampler is loaded from there when it was built for the same key, or
+    for the same matrix hash if no key is given, otherwise it is built and
+    saved to cache_file. The matrix is hashed only in this case
+    """
+    if key is not None :
+        ident = ('key', key)
+    else :
+        ident = ('id', id (P))
+    if ident in _samplers and (cache_file is None or os.path.exists (cache_file)) :
+        ref, sampler = _samplers [ident]
+        if ref is None or ref () is P :
+            return sampler
+    sampler = None
+    file_key = None
+    if cache_file is not None :
+        # the key is saved as a string
+        file_key = matrix_hash (P) if key is None else str (key)
+        if os.path.exists (cache_file) :
+            sampler = TransitionSampler.load (cache_file)
+            if sampler.key != file_key :
+                sampler = None
+    if sampler is None :
+        sampler = TransitionSampler.from_matrix (P, key=file_key)
+        if cache_file is not None :
+            sampler.save (cache_file)
+    if len (_samplers) >= _samplers_maxsize :
+        _samplers.pop (next (iter (_samplers)))
+    _samplers [ident] = (weakref.ref (P) if ident [0] == 'id' else None, sampler)
+    return sampler
+
+@span ("walk_many")
+def walk_many (i0, nsteps, Pn, seed=None, block_size=2**20) :
+    """
+    Perform the searches of many walkers at once on the system described by
+    the cumulative probability matrix Pn, or by its TransitionSampler. The
+    walkers start at the sites i0 and each one performs nsteps steps, which can
+    be a single number or an array of per-walker lifetimes. Return the total
+    number of visits to each site
+    """
+    if isinstance (Pn, TransitionSampler) :
+        jump = Pn.jump
+    else :
+        jump = lambda rows, u : jump_many (Pn, rows, u)
+    i = np.atleast_1d (i0).astype (np.intp)
+    nwalkers = len (i)
+    nsites = Pn.shape [0]
+    lifetimes = np.zeros (nwalkers, dtype=np.int64)
+    lifetimes [:] = nsteps
+    rng = get_rng (seed)
+    # sort walkers by decreasing lifetime, so that the walkers still alive at
+    # any step are the first ones
+    order = np.argsort (-lifetimes, kind='mergesort')
+    i = i [order]
+    lifetimes = lifetimes [order]
+    visits = np.zeros (nsites, dtype=int)
+    tmax = lifetimes [0] if nwalkers > 0 else 0
+    nalive = nwalkers
+    positions = []
+    npositions = 0
+    for t in range (tmax) :
+        while lifetimes [nalive-1] <= t :
+            nalive -= 1
+        i = i [:nalive]
+        positions.append (i)
+        npositions += nalive
+        # accumulate the visits in blocks, to avoid a full bincount per step
+        if npositions >= block_size :
+            visits += np.bincount (np.concatenate (positions), minlength=nsites)
+            positions = []
+            npositions = 0
+        i = jump (i, rng.random_sample (nalive))
+    if positions :
+        visits += np.bincount (np.concatenate (positions), minlength=nsites)
+    add_count ("walkers", nwalkers)
+    add_count ("steps", int (np.sum (lifetimes)))
+    return visits
+
+@span ("do_the_search")
 def do_the_search (i0, nsteps, P) :
     """
     Perform a search of nsteps on the system described by the transition
@@ -24,85 +241,210 @@ def do_the_search (i0, nsteps, P) :
         i = jump_to (P [i])
     return visits
 
+# default batching of the Monte Carlo equilibrium distribution: at most
+# max_walkers walkers, each one making at least min_walker_steps steps
+max_walkers = 1000
+min_walker_steps = 1000
+
+@span ("get_equilibrium_distribution")
 def get_equilibrium_distribution (P,
                                   from_eigs=False,
                                   from_iter=False,
                                   nsteps=100000,
                                   ntrials=10,
                                   niter=100,
-                                  divide_by_sum=True) :
+                                  divide_by_sum=True,
+                                  nwalkers=None,
+                                  seed=None,
+                                  sampler=None,
+                                  tol=None) :
     """
     Calculate equilibrium distribution of a random walk on the row-normalized
     graph described by the matrix P. Return the vector that corresponds to the
-    found solution
+    found solution. In the Monte Carlo mode, the ntrials*nsteps steps are split
+    among nwalkers walkers that move all at once. By default, there are as
+    many walkers as possible, up to max_walkers, such that each one makes at
+    least min_walker_steps steps (but at least one walker per trial). A
+    precomputed TransitionSampler of P can be passed as sampler. If tol is
+    given with from_iter, iterate until convergence (at most niter times), see
+    stationary_distribution
     """
     nsites = P.shape[0]
     if from_eigs :
+        from scipy.sparse.linalg import eigs
         hw, hv = eigs (P.T,k=1,which='LM')
         # select the index of the largest eigenvalue
         imax = hw.argmax ()
         # select the eigenvector corresponding to the largest eigenvalue
         population = hv [:,imax].real
+    elif from_iter and tol is not None :
+        population, info = stationary_distribution (P, tol=tol, maxiter=niter)
     elif from_iter :
         population = 1./nsites * np.ones (nsites)
         for i in range (niter) :
-            population = np.dot (population,P)
+            population = P.T.dot (population)
     else :
-        i0 = np.random.randint (0,nsites,ntrials)
-        Pn = np.cumsum (P,axis=1)
-        visits = np.array ([do_the_search (i, nsteps, Pn)\
-                            for i in range (ntrials)])
+        rng = get_rng (seed)
+        if nwalkers is None :
+            nwalkers = min (max_walkers, max (ntrials, (ntrials*nsteps)//min_walker_steps))
+        i0 = rng.randint (0,nsites,nwalkers)
+        if sampler is None :
+            sampler = get_transition_sampler (P)
+        visits = walk_many (i0, (ntrials*nsteps)//nwalkers, sampler, seed=rng)
         # get the population from average visits
-        population = np.mean (visits, axis=0)
+        population = visits/float (ntrials)
     # final result
     if divide_by_sum :
         return population/np.sum(population)
     else :
         return population
 
-def get_life_and_death (P, P_gene, tau, where='prom', ntrials=10, hic_res=2000) :
+@span ("stationary_distributions")
+def stationary_distributions (Ps, X0=None, tol=1e-10, maxiter=10000, method='power') :
+    """
+    Calculate the equilibrium distributions of the random walks on the list of
+    row-normalized matrices Ps (dense or sparse, all of the same size), until
+    the L1 norm of the change of each distribution in one step is below tol.
+    X0 gives the start vectors, one per matrix or a single one for all of them,
+    for example the solutions of a previous point of a parameter sweep.
+
+    With method='power', the power iterations of all the matrices are done
+    together, as a single product with the block-diagonal matrix of the
+    sparse matrices. With method='arnoldi', each distribution is found with
+    eigs. Return the distributions, one per row, and a dictionary with the
+    number of iterations (matrix-vector products) and the final residual of
+    each of them.
+    """
+    K = len (Ps)
+    N = Ps[0].shape[0]
+    X = np.empty ((K,N))
+    X [:] = 1./N if X0 is None else X0
+    X /= np.sum (X,axis=1).reshape (K,1)
+    niter = np.zeros (K, dtype=int)
+    residual = np.zeros (K)
+    if method == 'power' :
+        if all ([scipy.sparse.issparse (P) for P in Ps]) :
+            B = scipy.sparse.block_diag ([P.T for P in Ps], format='csr')
+            step = lambda X : B.dot (X.ravel ()).reshape (K,N)
+        else :
+            step = lambda X : np.array ([P.T.dot (x) for P, x in zip (Ps, X)])
+        active = np.ones (K, dtype=bool)
+        for i in range (maxiter) :
+            Y = step (X)
+            Y /= np.sum (Y,axis=1).reshape (K,1)
+            res = np.sum (np.abs (Y-X),axis=1)
+            # converged distributions are not updated anymore
+            X [active] = Y [active]
+            residual [active] = res [active]
+            niter [active] = i+1
+            active &= res > tol
+            if not active.any () :
+                break
+    elif method == 'arnoldi' :
+        from scipy.sparse.linalg import eigs, LinearOperator
+        for k, P in enumerate (Ps) :
+            PT = P.T
+            count = [0]
+            def matvec (x) :
+                count [0] += 1
+                return PT.dot (x)
+            op = LinearOperator ((N,N), matvec=matvec, dtype=np.float64)
+            hw, hv = eigs (op, k=1, which='LM', v0=X[k], tol=tol, maxiter=maxiter)
+            x = hv [:,0].real
+            X [k] = x/np.sum (x)
+            y = PT.dot (X[k])
+            residual [k] = np.sum (np.abs (y/np.sum (y)-X[k]))
+            niter [k] = count [0]
+    else :
+        raise ValueError ("Unknown method %s" % method)
+    add_count ("iterations", int (np.sum (niter)))
+    return X, {'niter' : niter, 'residual' : residual}
+
+def stationary_distribution (P, x0=None, tol=1e-10, maxiter=10000, method='power') :
+    """
+    Same as stationary_distributions, for a single matrix P
+    """
+    X, info = stationary_distributions ([P], X0=x0, tol=tol, maxiter=maxiter,
+                                        method=method)
+    return X[0], {'niter' : int (info['niter'][0]),
+                  'residual' : float (info['residual'][0])}
+
+@span ("stationary_sweep")
+def stationary_sweep (P_hop, P_gene, p_firing_values, block_size=4,
+                      tol=1e-10, maxiter=10000, method='power') :
+    """
+    Calculate the equilibrium distributions of the matrices obtained with
+    P_hop_plus_gene for all the values in p_firing_values. The matrices are
+    solved block_size at a time, each block starting from the last solution of
+    the previous one. Return the distributions, one per row, and the number of
+    iterations and residuals as in stationary_distributions.
+    """
+    mixer = HopGeneMixer (P_hop, P_gene)
+    populations = []
+    niter = []
+    residual = []
+    x0 = None
+    for n in range (0, len (p_firing_values), block_size) :
+        Ps = [mixer (p) for p in p_firing_values [n:n+block_size]]
+        X, info = stationary_distributions (Ps, X0=x0, tol=tol, maxiter=maxiter,
+                                            method=method)
+        x0 = X[-1]
+        populations.append (X)
+        niter.append (info['niter'])
+        residual.append (info['residual'])
+    return np.concatenate (populations), {'niter' : np.concatenate (niter),
+                                          'residual' : np.concatenate (residual)}
+
+@span ("get_life_and_death")
+def get_life_and_death (P, P_gene, tau, where='prom', ntrials=10, hic_res=2000,
+                        seed=None, sampler=None) :
     """
     Get the population of the graph if including the following hypothesis: the
-    particles may start only at the promoters, terminators, or both.
+    particles may start only at the promoters, terminators, or both. All the
+    particles are moved at once, each one with its exponentially distributed
+    lifetime. A precomputed TransitionSampler of P can be passed as sampler
     """
+    rng = get_rng (seed)
     nsites = P.shape[0]
     # select starting sites depending on the "where" parameters, passed to the
     # function
-    promoters, terminators = np.where (P_gene)
+    promoters, terminators = P_gene.nonzero ()
     if where=='prom' :
-        i0 = np.random.choice (promoters,size=ntrials)
+        i0 = rng.choice (promoters,size=ntrials)
     elif where=='term' :
-        i0 = np.random.choice (terminators,size=ntrials)
+        i0 = rng.choice (terminators,size=ntrials)
     elif where=='both' :
-        i0 = np.random.choice (np.concatenate((promoters,terminators)),size=ntrials)
-    # calculate the cumulative sum probability matrix
-    Pn = np.cumsum (P,axis=1)
-    visits = np.zeros (nsites)
-    for i in range (ntrials) :
-        t = int (np.random.exponential (tau))+1
-        visits += do_the_search (i0[i],t,Pn)
+        i0 = rng.choice (np.concatenate((promoters,terminators)),size=ntrials)
+    # get the sampling index of the probability matrix
+    if sampler is None :
+        sampler = get_transition_sampler (P)
+    lifetimes = rng.exponential (tau,size=ntrials).astype (int)+1
+    visits = walk_many (i0,lifetimes,sampler,seed=rng).astype (float)
     # get the population from average visits
     mean = np.mean (visits)
     return visits/mean
 
+@span ("propagate_dirac_comb")
 def propagate_dirac_comb (startsites, P, nsteps=100, with_identity=False) :
     """
     Propagates a solution of elements starting at sites described
     by the array of indices startsites, using the probability
-    matrix P, with nsteps
+    matrix P (dense or sparse), with nsteps
     """
     nsites = P.shape [0]
+    # x P is computed as P.T x, which works for both dense and sparse P
+    PT = P.T
     # initialize matrix
     X = np.zeros ((nsteps,nsites))
     if with_identity :
         X[0,:] = startsites
     else :
-        X[0,:] = np.dot (startsites,P)
+        X[0,:] = PT.dot (startsites)
     for i in range (1,nsteps) :
         # get state at previous step
         x = X[i-1,:]
         # feed it to the evolution matrix
-        X[i,:] = np.dot (x,P)
+        X[i,:] = PT.dot (x)
     return X
 
 def weigh_with_exponential (X, tau, with_identity=False) :
@@ -113,16 +455,108 @@ def weigh_with_exponential (X, tau, with_identity=False) :
     half-life tau
     """
     nsteps = X.shape [0]
-    nsites = X.shape [1]
     if with_identity :
         steps = np.arange (0,nsteps,1)
     else :
         steps = np.arange (1,nsteps+1,1)
     p = np.exp (-steps/tau)
-    predicted = np.zeros (nsites)
-    for i, x in enumerate (X) :
-        predicted += p[i] * x
-    return predicted
+    return np.dot (p, X)
+
+def exponential_nsteps (tau, tol=1e-8, with_identity=False) :
+    """
+    Returns the number of steps needed for the sum of the exp-weighted steps
+    to be accurate within tol, relative to the total population. Since P is
+    row-normalized, each step carries the same population, so the tail of the
+    sum after T steps is bounded by the geometric series sum_{t>T} e^{-t/tau}
+    """
+    w = np.exp (-1./tau)
+    t0 = 0 if with_identity else 1
+    return max (1, int (np.ceil (np.log (tol*(1.-w))/np.log (w))) - t0)
+
+@span ("propagate_exponential")
+def propagate_exponential (startsites, P, Tau, with_identity=False,
+                           nsteps=None, tol=1e-8, method='series') :
+    """
+    Returns sum_t e^{-t/tau} x P^t, with x=startsites, which is the same as
+    weigh_with_exponential (propagate_dirac_comb (x, P, nsteps), tau), without
+    storing the intermediate steps. startsites can be a single vector or a
+    matrix with one start vector per row, and P can be dense or sparse.
+
+    With method='series', the steps are accumulated as they are computed,
+    for all the values in Tau at once. If nsteps is None, it is chosen with
+    exponential_nsteps so that the error is below tol. With method='resolvent',
+    the infinite sum is obtained by solving x (I - e^{-1/tau} P)^{-1}.
+
+    If Tau is a single value, the result has the shape of startsites,
+    otherwise it has one more leading dimension, one entry per tau.
+    """
+    Tau = np.asarray (Tau, dtype=float)
+    taus = np.atleast_1d (Tau)
+    x = np.asarray (startsites, dtype=float)
+    result = np.zeros ((len (taus),) + x.shape)
+    if method == 'series' :
+        if nsteps is None :
+            nsteps = exponential_nsteps (taus.max (), tol, with_identity)
+        # x P is computed as (P.T x.T).T, for dense and sparse P
+        PT = P.T
+        y = x if with_identity else PT.dot (x.T).T
+        w = np.exp (-1./taus).reshape ((-1,) + (1,)*x.ndim)
+        wt = w.copy () if not with_identity else np.ones_like (w)
+        for t in range (nsteps) :
+            result += wt*y
+            if t < nsteps-1 :
+                wt *= w
+                y = PT.dot (y.T).T
+    elif method == 'resolvent' :
+        nsites = P.shape [0]
+        for k, tau in enumerate (taus) :
+            w = np.exp (-1./tau)
+            # solve (I - w P.T) y.T = x.T
+            if scipy.sparse.issparse (P) :
+                from scipy.sparse.linalg import splu
+                M = scipy.sparse.identity (nsites, format='csc') - w*scipy.sparse.csc_matrix (P.T)
+                y = splu (M).solve (x.T.copy ()).T
+            else :
+                y = np.linalg.solve (np.identity (nsites) - w*np.asarray (P).T, x.T).T
+            result [k] = y if with_identity else y-x
+    else :
+        raise ValueError ("Unknown method %s" % method)
+    if Tau.ndim == 0 :
+        return result [0]
+    return result
+
+@span ("exponential_matrix_sum")
+def exponential_matrix_sum (P, Tau, with_identity=False, tol=1e-8, dtype=np.float64) :
+    """
+    Returns the matrix A_tau = sum_t e^{-t/tau} P^t, or the list of matrices
+    if Tau is a list of values, truncated so that the error is below tol (see
+    exponential_nsteps). The sums are computed by doubling the number of terms,
+    S_2n = S_n + e^{-n/tau} P^n S_n, so that the powers P^n are computed once
+    and shared by all the values of tau
+    """
+    taus = np.atleast_1d (np.asarray (Tau, dtype=float))
+    if scipy.sparse.issparse (P) :
+        P = P.toarray ()
+    P = np.asarray (P, dtype=dtype)
+    nsites = P.shape [0]
+    # number of terms, starting from t=0, needed for each tau
+    nterms = [exponential_nsteps (tau, tol, with_identity=True) for tau in taus]
+    S = [np.identity (nsites, dtype=dtype) for tau in taus]
+    Pn = P
+    n = 1
+    while n < max (nterms) :
+        for k, tau in enumerate (taus) :
+            if n < nterms [k] :
+                S [k] += np.exp (-n/tau) * np.dot (Pn, S [k])
+        n *= 2
+        if n < max (nterms) :
+            Pn = np.dot (Pn, Pn)
+    if not with_identity :
+        for A in S :
+            A [np.diag_indices (nsites)] -= 1.
+    if np.ndim (Tau) == 0 :
+        return S [0]
+    return S
 
 def propagate_dirac_comb_k (k, startsites, P, nsteps=100) :
     """
@@ -131,77 +565,157 @@ def propagate_dirac_comb_k (k, startsites, P, nsteps=100) :
     sites = np.append (startsites, k)
     return propagate_dirac_comb (sites, P, nsteps=nsteps)
 
+class DiffusionObjective :
+    """
+    Objective function to minimize when optimizing the start vector x for a
+    diffusion on a Hi-C matrix, with the quantities that do not depend on x
+    precomputed. Calling it with x returns the function and its gradient.
+    The gradient is computed with matrix-vector products only, so no N*N
+    temporary is allocated, and A can be stored as float32 or memory-mapped.
+    """
+    def __init__ (self,A,expr,mask) :
+        self.A = A
+        self.mask = mask
+        self.expr = np.where (mask, expr, 0.)
+        # mean of each row of A
+        self.mAl = np.mean (A,axis=1,dtype=np.float64)
+    def __call__ (self,x) :
+        A = self.A
+        xA = np.dot (x.astype (A.dtype),A).astype (np.float64)
+        mxA = np.mean (xA)
+        # h and w are computed on the mask only: xA is zero at the empty
+        # columns of A (zero rows of the Hi-C matrix)
+        with np.errstate (divide='ignore', invalid='ignore') :
+            h = np.log2 (xA/mxA)
+            h_minus_expr = np.where (self.mask, h-self.expr, 0.)
+            # dh_j/dx_i = (A_ij/xA_j - mAl_i/mxA)/ln(2)
+            w = np.where (self.mask, h_minus_expr/xA, 0.).astype (A.dtype)
+        F = np.sum (h_minus_expr**2)
+        df = np.dot (A,w) - np.sum (h_minus_expr)*self.mAl/mxA
+        # 2/ln(2) = 2.8853900817779268
+        return F, 2.8853900817779268*df
+
+class ContactsObjective :
+    """
+    Objective function to minimize when optimizing the start vector x for a
+    contact vector with Hi-C matrix, with the quantities that do not depend
+    on x precomputed, as in DiffusionObjective.
+    """
+    def __init__ (self,A,expr,mask) :
+        self.A = A
+        self.mask = mask
+        self.expr = np.where (mask, expr, 0.)
+        # mean of each column of A
+        self.mAc = np.mean (A,axis=0,dtype=np.float64)
+    def __call__ (self,x) :
+        A = self.A
+        xA = np.dot (A,x.astype (A.dtype)).astype (np.float64)
+        mxA = np.mean (xA)
+        # h and w are computed on the mask only, as in DiffusionObjective: xA
+        # is zero at the empty rows of A
+        with np.errstate (divide='ignore', invalid='ignore') :
+            h = np.log2 (xA/mxA)
+            h_minus_expr = np.where (self.mask, h-self.expr, 0.)
+            # dh_i/dx_k = (A_ik/xA_i - mAc_k/mxA)/ln(2)
+            w = np.where (self.mask, h_minus_expr/xA, 0.).astype (A.dtype)
+        F = np.sum (h_minus_expr**2)
+        df = np.dot (w,A) - np.sum (h_minus_expr)*self.mAc/mxA
+        # 2/ln(2) = 2.8853900817779268
+        return F, 2.8853900817779268*df
+
 def obj_diffusion (x,A,expr,mask) :
     """
     Objective function to minimize when optimizing the start vector for a
     diffusion on a Hi-C matrix. Return the gradient along with the function for
-    an efficient calculation of both.
-    """
-    xA = np.dot (x,A)
-    mxA = np.mean (xA)
-    h = np.log2 (xA/mxA)
-    h_minus_expr = h-expr 
-    F = np.sum ((h_minus_expr**2)[mask])
-    mAl = np.mean (A,axis=1)
-    dh = ((A/xA).T - mAl/mxA).T
-    df = np.sum ((h_minus_expr*dh)[:,mask],axis=1)
-    # 2/ln(2) = 2.8853900817779268
-    return F, 2.8853900817779268*df
-
-# the constraints
+    an efficient calculation of both. When evaluating it many times with the
+    same A, use DiffusionObjective instead.
+    """
+    return DiffusionObjective (A,expr,mask) (x)
+
+# the constraints: the start vector sums to one. The positivity of x is given
+# to SLSQP as bounds, which avoids building an N*N Jacobian at each evaluation
 cons = ({'type': 'eq',
                  'fun' : lambda x: np.sum (x)-1,
-                 'jac' : lambda x: np.ones (len (x))},
-        {'type': 'ineq',
-                 'fun' : lambda x: 1-x,
-                 'jac' : lambda x: np.identity (len(x))},
-        {'type': 'ineq',
-                 'fun' : lambda x: x,
-                 'jac' : lambda x: np.identity (len(x))})
+                 'jac' : lambda x: np.ones (len (x))},)
+
+def softmax (z) :
+    e = np.exp (z-np.max (z))
+    return e/np.sum (e)
+
+def optimize_simplex (obj, xstart, args=(), disp=True, maxiter=100) :
+    """
+    Minimize obj, which returns the function and its gradient, on the simplex
+    (x>=0, sum(x)=1), writing x=softmax(z) and using L-BFGS-B on the
+    unconstrained z. The result has the optimal x in res.x
+    """
+    def obj_z (z) :
+        x = softmax (z)
+        F, g = obj (x, *args)
+        # chain rule through the softmax
+        return F, x*(g-np.dot (x,g))
+    from scipy.optimize import minimize
+    z0 = np.log (np.maximum (xstart, 1e-12))
+    res = minimize (obj_z,
+                    z0,
+                    jac=True,
+                    method='L-BFGS-B',
+                    options={'disp': disp,'maxiter' : maxiter})
+    res.x = softmax (res.x)
+    return res
 
-def optimize_start_diffusion (xstart,A,expr,mask,disp=True) :
+@span ("optimize_start")
+def optimize_start (obj,xstart,disp=True,method='SLSQP',maxiter=100) :
+    """
+    Minimize obj, which returns the function and its gradient, for the start
+    vector x, subject to x>=0 and sum(x)=1. With method='SLSQP', the
+    constraints are given explicitly to the solver, with method='softmax',
+    they are satisfied by construction (see optimize_simplex)
+    """
+    if method == 'SLSQP' :
+        from scipy.optimize import minimize
+        res = minimize (obj,
+                        xstart,
+                        jac=True,
+                        bounds=[(0.,1.)]*len (xstart),
+                        constraints=cons,
+                        method='SLSQP',
+                        options={'disp': disp,'maxiter' : maxiter})
+    elif method == 'softmax' :
+        res = optimize_simplex (obj, xstart, disp=disp, maxiter=maxiter)
+    else :
+        raise ValueError ("Unknown method %s" % method)
+    add_count ("iterations", int (res.get ('nit', 0)))
+    add_count ("evaluations", int (res.get ('nfev', 0)))
+    return res
+
+def optimize_start_diffusion (xstart,A,expr,mask,disp=True,method='SLSQP',maxiter=100) :
     """
     Optimize the start vector of the diffusion of factors in a Hi-C matrix. The
     matrix A must be precomputed to be the exp-weighed powers of P, which was
     previously row-normalized. Provide the full expr_binned vector along with a
     pre-calculated mask describing the valid values of the expr_binned vector
     """
-    res = minimize (obj_diffusion,
-                    xstart,
-                    args=(A,expr,mask),
-                    jac=True,
-                    constraints=cons,
-                    method='SLSQP',
-                    options={'disp': disp,'maxiter' : 100})
-    return res
+    return optimize_start (DiffusionObjective (A,expr,mask),xstart,
+                           disp=disp,method=method,maxiter=maxiter)
 
 # the function to minimize
 def obj_contacts (x,A,expr,mask) :
     """
     Objective function to minimize when optimizing the start vector for a
-    contact vector with Hi-C matrix.
+    contact vector with Hi-C matrix. Return the gradient along with the
+    function, as in obj_diffusion. When evaluating it many times with the
+    same A, use ContactsObjective instead.
     """
-    xA = np.dot (A,x)
-    mxA = np.mean (xA)
-    h = np.log2 (xA/mxA)
-    h_minus_expr = h-expr 
-    F = np.sum ((h_minus_expr**2)[mask])
-    return F
+    return ContactsObjective (A,expr,mask) (x)
 
-def optimize_start_contacts (xstart,P,expr,mask,disp=True) :
+def optimize_start_contacts (xstart,P,expr,mask,disp=True,method='SLSQP',maxiter=100) :
     """
     Optimize the start vector of the contacts of sites in a Hi-C matrix. P was
     previously row-normalized. Provide the full expr_binned vector along with a
     pre-calculated mask describing the valid values of the expr_binned vector
     """
-    res = minimize (obj_contacts,
-                    xstart,
-                    args=(P,expr,mask),
-                    jac=False,
-                    constraints=cons,
-                    method='SLSQP',
-                    options={'disp': disp,'maxiter' : 100})
-    return res
+    return optimize_start (ContactsObjective (P,expr,mask),xstart,
+                           disp=disp,method=method,maxiter=maxiter)
 
 def get_xstart (N,in_xstart_file=None,out_xstart_file=None) :
     """
@@ -218,14 +732,17 @@ def get_xstart (N,in_xstart_file=None,out_xstart_file=None) :
             np.savetxt (out_xstart_file,xstart)
         return xstart
 
+@span ("optimize_model")
 def optimize_model (what,matrix,expr,mask,target_fval=None,
                     in_xstart_file=None,
                     out_xstart_file=None,
                     disp=True,
-                    maxiter=5) :
+                    maxiter=5,
+                    method='SLSQP') :
     """
     This function allows to get to the correct optimizing procedure, and iterate
-    until the target f value is lower than the supplied one
+    until the target f value is lower than the supplied one. method is passed
+    to optimize_start
     """
     # what shall we optimize?
     if what == 'contacts' :
@@ -236,11 +753,12 @@ def optimize_model (what,matrix,expr,mask,target_fval=None,
     N = matrix.shape[0]
     xstart = get_xstart (N,in_xstart_file,out_xstart_file)
     # optimize the first time
-    res = target_f (xstart,matrix,expr,mask,disp=disp)
+    res = target_f (xstart,matrix,expr,mask,disp=disp,method=method)
     if target_fval is not None :
         niter = 0
         while (res.fun > target_fval and niter < maxiter) :
             xstart = get_xstart (N,in_xstart_file=None,out_xstart_file=out_xstart_file)
-            res = target_f (xstart,matrix,expr,mask,disp=disp)
+            res = target_f (xstart,matrix,expr,mask,disp=disp,method=method)
             niter += 1
+            add_count ("restarts")
     return res.x
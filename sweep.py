@@ -0,0 +1,204 @@
+"""
+Parameter sweeps of the life-and-death and diffusion models of a chromosome.
+A sweep is described by a grid, a dict mapping each parameter to the list of
+its values, and runs all the combinations of the values. The intermediates
+shared by the points of the grid are computed only once: the mixed matrix and
+its TransitionSampler for each p_firing, and, for the diffusion model, the
+propagated populations of the three kinds of start sites for all the values of
+tau at once.
+
+Each point is identified by a hash of its parameters and of the input
+matrices, and its result is stored in sweep_cache_dir, so that running the
+sweep again, or on an extended grid, only computes the new points.
+"""
+import numpy as np
+import os, json, hashlib, itertools
+from .messages import log_message
+from .data_process import row_normalize_matrix, HopGeneMixer, ModelScorer
+from .gene_expression import gene_expression_probability_matrix, always_fire
+from .sims import matrix_hash, get_transition_sampler, get_life_and_death, propagate_exponential
+
+sweep_cache_dir = os.getenv ("HOME") + "/work/data/tripsims/sweeps"
+
+# parameters of each model, with their default values (None if required)
+model_parameters = {
+    'life_and_death' : {'tau' : None, 'where' : 'prom', 'p_firing' : 0.,
+                        'ntrials' : 10, 'seed' : 0},
+    'diffusion' : {'tau' : None, 'where' : 'prom', 'p_firing' : 0.,
+                   'with_identity' : False},
+}
+
+wheres = ['prom', 'term', 'both']
+
+def expand_grid (grid, model) :
+    """
+    Returns the list of the configurations (dicts) of all the combinations of
+    the values in grid, with the missing parameters set to their default
+    """
+    defaults = model_parameters [model]
+    for name in grid :
+        if name not in defaults :
+            raise ValueError ("Unknown parameter %s for model %s" % (name, model))
+    names = sorted (grid.keys ())
+    configs = []
+    for values in itertools.product (*[grid [name] for name in names]) :
+        config = dict (defaults)
+        config.update (zip (names, values))
+        for name, value in config.items () :
+            if value is None :
+                raise ValueError ("Missing parameter %s for model %s" % (name, model))
+        configs.append (config)
+    return configs
+
+def _plain (value) :
+    # numpy scalars are not serializable to JSON
+    if isinstance (value, np.generic) :
+        return value.item ()
+    return value
+
+def _key_value (value) :
+    # numbers are hashed as floats, so that e.g. p_firing=0 and p_firing=0.
+    # give the same key
+    value = _plain (value)
+    if isinstance (value, (int, float)) and not isinstance (value, bool) :
+        return float (value)
+    return value
+
+def config_key (config) :
+    """
+    Returns the hash of a configuration. The numeric values are converted to
+    floats first
+    """
+    s = json.dumps (dict ([(k, _key_value (v)) for k, v in config.items ()]), sort_keys=True)
+    return hashlib.sha1 (s.encode ()).hexdigest ()
+
+def result_file (key) :
+    return "%s/%s/%s.json" % (sweep_cache_dir, key [:2], key)
+
+def load_result (key) :
+    """
+    Returns the cached result of the configuration with hash key, or None
+    """
+    fname = result_file (key)
+    if not os.path.exists (fname) :
+        return None
+    with open (fname) as f :
+        return json.load (f) ['result']
+
+def save_result (key, config, result) :
+    fname = result_file (key)
+    d = os.path.dirname (fname)
+    if not os.path.exists (d) :
+        os.makedirs (d)
+    tmp = "%s.%d.tmp" % (fname, os.getpid ())
+    with open (tmp, 'w') as f :
+        json.dump ({'config' : dict ([(k, _plain (v)) for k, v in config.items ()]),
+                    'result' : result}, f)
+    os.rename (tmp, fname)
+
+def start_sites (P_gene) :
+    """
+    Returns the start vectors of the diffusion model for the promoters, the
+    terminators and both, one per row, with the same start sites as
+    get_life_and_death
+    """
+    N = P_gene.shape [0]
+    promoters, terminators = P_gene.nonzero ()
+    x = np.zeros ((len (wheres), N))
+    x [0] = np.bincount (promoters, minlength=N)
+    x [1] = np.bincount (terminators, minlength=N)
+    x [2] = x [0] + x [1]
+    return x
+
+def _run_life_and_death (configs, P, P_gene) :
+    sampler = get_transition_sampler (P)
+    return [get_life_and_death (P, P_gene, c ['tau'], where=c ['where'],
+                                ntrials=c ['ntrials'], seed=c ['seed'], sampler=sampler)
+            for c in configs]
+
+def _run_diffusion (configs, P, P_gene) :
+    populations = [None]*len (configs)
+    x = start_sites (P_gene)
+    for with_identity in sorted (set ([c ['with_identity'] for c in configs])) :
+        group = [k for k, c in enumerate (configs) if c ['with_identity'] == with_identity]
+        Tau = sorted (set ([configs [k] ['tau'] for k in group]))
+        # one propagation for all the start sites and all the values of tau
+        X = propagate_exponential (x, P, Tau, with_identity=with_identity)
+        for k in group :
+            c = configs [k]
+            p = X [Tau.index (c ['tau']), wheres.index (c ['where'])]
+            populations [k] = p/np.mean (p)
+    return populations
+
+_runners = {
+    'life_and_death' : _run_life_and_death,
+    'diffusion' : _run_diffusion,
+}
+
+def results_table (configs, r2) :
+    """
+    Returns the tidy table of the results, a structured array with one row
+    per configuration, one column per parameter and the column r2
+    """
+    names = sorted (configs [0].keys ())
+    columns = [np.array ([_plain (c [name]) for c in configs]) for name in names]
+    dtype = [(name, column.dtype) for name, column in zip (names, columns)]
+    table = np.empty (len (configs), dtype=dtype + [('r2', float)])
+    for name, column in zip (names, columns) :
+        table [name] = column
+    table ['r2'] = r2
+    return table
+
+def run_sweep (chromosome, grid, model='life_and_death', bias=0.01,
+               firing=(always_fire,None), cache=True) :
+    """
+    Runs the model for all the configurations of grid on the chromosome (a
+    Chromosome object), and returns the table of the R2 of the populations
+    with the binned reporter expression (see results_table). model can be
+    'life_and_death' (see get_life_and_death) or 'diffusion' (the same walk,
+    as the exponentially weighted propagation of the start sites, see
+    propagate_exponential). The results are read from and stored to the
+    sweep cache unless cache is False
+    """
+    if model not in _runners :
+        raise ValueError ("Unknown model %s" % model)
+    configs = expand_grid (grid, model)
+    P_hop = row_normalize_matrix (chromosome.H)
+    P_gene = gene_expression_probability_matrix (chromosome.N, chromosome.genes, firing,
+                                                 sparse=True)
+    # the inputs are part of the hash of each point
+    h = hashlib.sha1 ()
+    for a in (chromosome.expr_binned, chromosome.zerorows) :
+        h.update (np.ascontiguousarray (a).view (np.uint8).reshape (-1))
+    base = {'model' : model, 'chromosome' : chromosome.name, 'bias' : bias,
+            'hic' : matrix_hash (P_hop), 'gene' : matrix_hash (P_gene),
+            'expr' : h.hexdigest ()}
+    keys = []
+    for c in configs :
+        full = dict (base)
+        full.update (c)
+        keys.append (config_key (full))
+    r2 = np.empty (len (configs))
+    todo = []
+    for k, key in enumerate (keys) :
+        result = load_result (key) if cache else None
+        if result is None :
+            todo.append (k)
+        else :
+            r2 [k] = result
+    log_message ("run_sweep", "%s, chromosome %s: %d points, %d cached" %
+                 (model, chromosome.name, len (configs), len (configs)-len (todo)))
+    if todo :
+        scorer = ModelScorer (chromosome.expr_binned, chromosome.zerorows, bias)
+        mixer = HopGeneMixer (P_hop, P_gene)
+        for p_firing in sorted (set ([configs [k] ['p_firing'] for k in todo])) :
+            group = [k for k in todo if configs [k] ['p_firing'] == p_firing]
+            P = mixer (p_firing) if p_firing != 0. else P_hop
+            populations = _runners [model] ([configs [k] for k in group], P, P_gene)
+            for k, population in zip (group, populations) :
+                r2 [k] = scorer.r2 (population)
+                if cache :
+                    full = dict (base)
+                    full.update (configs [k])
+                    save_result (keys [k], full, float (r2 [k]))
+    return results_table (configs, r2)
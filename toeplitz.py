@@ -0,0 +1,57 @@
+"""
+Matrices of the p(s) function as linear operators, that are not stored. They
+are kept apart from data_process, so that loading the data does not import
+scipy.sparse.linalg.
+"""
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+from .data_process import ps_kernel
+
+class ToeplitzOperator (LinearOperator) :
+    """
+    The symmetric Toeplitz matrix T_ij = kernel[|i-j|] as a linear operator,
+    without storing the matrix. Products with vectors or matrices cost
+    O(N log N) per vector, using the FFT of the circulant embedding of T. If
+    normalize is True, the operator is the row-normalized matrix D^-1 T, D
+    being the diagonal matrix of the row sums of T.
+    """
+    def __init__ (self, kernel, normalize=False) :
+        N = len (kernel)
+        LinearOperator.__init__ (self, dtype=np.float64, shape=(N,N))
+        self.kernel = kernel
+        self.nfft = 2*N
+        # first column of the 2N*2N circulant matrix that contains T
+        c = np.concatenate ((kernel, [0.], kernel [:0:-1]))
+        self.fkernel = np.fft.rfft (c)
+        self.inv_rowsum = None
+        if normalize :
+            r = self.toeplitz_dot (np.ones (N))
+            self.inv_rowsum = np.ones (N)
+            self.inv_rowsum [r!=0.] = 1./r [r!=0.]
+    def toeplitz_dot (self, X) :
+        """
+        Returns T X, for a vector or for a matrix with one vector per column
+        """
+        N = self.shape [0]
+        f = self.fkernel.reshape ((-1,) + (1,)*(X.ndim-1))
+        Y = np.fft.irfft (f*np.fft.rfft (X, n=self.nfft, axis=0), n=self.nfft, axis=0)
+        return Y [:N]
+    def _scale (self, X) :
+        if self.inv_rowsum is None :
+            return X
+        return X*self.inv_rowsum.reshape ((-1,) + (1,)*(X.ndim-1))
+    def _matvec (self, x) :
+        return self._scale (self.toeplitz_dot (x))
+    def _matmat (self, X) :
+        return self._scale (self.toeplitz_dot (X))
+    def _rmatvec (self, x) :
+        return self.toeplitz_dot (self._scale (x))
+    def _rmatmat (self, X) :
+        return self.toeplitz_dot (self._scale (X))
+
+def power_law_operator (N,alpha,max_distance=None,normalize=False) :
+    """
+    Returns the matrix of power_law_matrix as a ToeplitzOperator, optionally
+    row-normalized
+    """
+    return ToeplitzOperator (ps_kernel (N,alpha,max_distance), normalize=normalize)
@@ -1,16 +1,100 @@
 import numpy as np
+import scipy.sparse
+import multiprocessing
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
-from matplotlib.lines import Line2D
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
 from .data_process import model_r2
+from .features import select_window
+
+# the tracks and matrices are reduced to about this number of points or pixels
+# per axis before plotting, which is more than the resolution of the figures
+max_pixels = 2000
+
+def new_figure (figsize, show=True) :
+    """
+    Returns a pyplot figure if show is True, otherwise a figure drawn by the
+    non-interactive Agg canvas, that does not need a display and can be used
+    in worker processes
+    """
+    if show :
+        return plt.figure (figsize=figsize)
+    fig = Figure (figsize=figsize)
+    FigureCanvasAgg (fig)
+    return fig
+
+def finish_figure (fig, show=True, fname=None) :
+    """
+    Saves the figure to fname, if given, and shows it if show is True
+    """
+    if fname is not None :
+        fig.savefig (fname)
+    if show :
+        plt.show ()
+
+def downsample_track (xvals, yvals, npoints=max_pixels) :
+    """
+    Returns at most npoints of the track: the values are grouped in npoints
+    bins of x, and in each bin the value of largest absolute value is kept, so
+    that the peaks of the track are preserved
+    """
+    if len (xvals) <= npoints :
+        return xvals, yvals
+    edges = np.linspace (np.min (xvals), np.max (xvals), npoints+1)
+    b = np.clip (np.searchsorted (edges, xvals, side='right')-1, 0, npoints-1)
+    order = np.lexsort ((-np.abs (yvals), b))
+    first = order [np.unique (b [order], return_index=True) [1]]
+    first.sort ()
+    return xvals [first], yvals [first]
+
+def downsample_matrix (H, npixels=max_pixels) :
+    """
+    Returns the dense or sparse square matrix H averaged over blocks, so that
+    it has at most npixels rows and columns
+    """
+    n = H.shape [0]
+    f = -(-n//npixels)
+    if f <= 1 :
+        return H.toarray () if scipy.sparse.issparse (H) else np.asarray (H)
+    starts = np.arange (0, n, f)
+    counts = np.diff (np.append (starts, n)).astype (float)
+    if scipy.sparse.issparse (H) :
+        m = len (starts)
+        R = scipy.sparse.csr_matrix ((np.ones (n), (np.arange (n)//f, np.arange (n))), shape=(m,n))
+        S = R.dot (H).dot (R.T).toarray ()
+    else :
+        S = np.add.reduceat (np.add.reduceat (H, starts, axis=0), starts, axis=1)
+    return S/np.outer (counts, counts)
+
+def stems (ax, xvals, yvals, npoints=max_pixels, **kwargs) :
+    """
+    Draws vertical lines from 0 to yvals at xvals, as a single LineCollection
+    of at most npoints lines
+    """
+    xvals, yvals = downsample_track (np.asarray (xvals), np.asarray (yvals), npoints)
+    segments = np.zeros ((len (xvals),2,2))
+    segments [:,:,0] = np.asarray (xvals).reshape (-1,1)
+    segments [:,1,1] = yvals
+    kwargs.setdefault ('colors', 'k')
+    kwargs.setdefault ('linewidths', 1)
+    ax.add_collection (LineCollection (segments, **kwargs))
 
 def visualize_model_results (population, expr_binned, reporters,
                    n1=1000, n2=2000, hic_res=2000, n_exclude=0,
-                   zerorows=None, title=None) :
-    fig = plt.figure (figsize=(20,10))
+                   zerorows=None, title=None, show=True, fname=None) :
+    """
+    Plots the population against the binned reporter expression, and the
+    population and reporters in the region [n1,n2). If fname is given, the
+    figure is saved there; if show is False, it is drawn without pyplot
+    """
+    fig = new_figure ((20,10), show)
     gs = gridspec.GridSpec (3,2)
-    ax = plt.subplot(gs[:,0])
-    ax.scatter (expr_binned [n_exclude:],np.log2(population))
+    ax = fig.add_subplot (gs[:,0])
+    with np.errstate (divide='ignore') :
+        logpop = np.log2 (population)
+    ax.scatter (expr_binned [n_exclude:],logpop,rasterized=True)
     ax.axhline (0,-15.,15.,linestyle='--',color='r',linewidth=3)
     ax.axvline (0,-2.5,2.0,linestyle='--',color='r',linewidth=3)
     ax.set_xlabel ("Reporter expression (log)", fontsize=24)
@@ -24,12 +108,13 @@ def visualize_model_results (population, expr_binned, reporters,
     ax.text (xmax-ratio*deltax,ymax-ratio*deltay, "$r^2 = %.2f$"%r2,
             fontsize=24)
     # total expression
-    ax2 = plt.subplot (gs[0,1])
-    ax2.plot (np.log2(population))
+    ax2 = fig.add_subplot (gs[0,1])
+    ax2.plot (*downsample_track (np.arange (len (logpop)), logpop))
     # zoom to region
     x = np.arange (n1,n2)
-    ax3 = plt.subplot (gs[1,1])
-    ax3.bar (x, np.log2(population[n1:n2]))
+    ax3 = fig.add_subplot (gs[1,1])
+    stems (ax3, x, logpop [n1:n2])
+    ax3.autoscale_view ()
     ax3.get_yaxis().tick_left()
     ax3.set_ylabel ("Average visits (log)", fontsize=16)
     ax3.get_xaxis().tick_bottom()
@@ -38,11 +123,13 @@ def visualize_model_results (population, expr_binned, reporters,
     ax3.spines['bottom'].set_visible(False)
     ax3.set_xlim (n1,n2)
     # reporter expression
-    ax4 = plt.subplot (gs[2,1],sharex=ax3)
-    myreporters = np.array ([r for r in reporters
-                             if (r['pos']-n_exclude)>n1*hic_res
-                             and (r['pos']-n_exclude)<n2*hic_res])
-    ax4.bar ((myreporters['pos']-n_exclude)/hic_res, myreporters['nexp'])
+    ax4 = fig.add_subplot (gs[2,1],sharex=ax3)
+    myreporters = select_window (reporters,
+                                 n1*hic_res+n_exclude,
+                                 n2*hic_res+n_exclude,
+                                 pos_field='pos')
+    stems (ax4, (myreporters['pos']-n_exclude)/float (hic_res), myreporters['nexp'])
+    ax4.autoscale_view ()
     ax4.spines['top'].set_visible(False)
     ax4.spines['right'].set_visible(False)
     ax4.get_yaxis().tick_left()
@@ -51,19 +138,26 @@ def visualize_model_results (population, expr_binned, reporters,
     # set title
     if title :
         fig.suptitle (title,fontsize=32)
-    plt.show ()
+    finish_figure (fig, show, fname)
     return fig
 
-def plot_hic_matrix (H,ax,N1,N2,hic_res=2000,offset=0) :
-    n1 = N1/hic_res
-    n2 = N2/hic_res
-    ax.matshow (1-np.log2(H[n1:n2,n1:n2]),
+def plot_hic_matrix (H,ax,N1,N2,hic_res=2000,offset=0,npixels=max_pixels) :
+    """
+    Plots the Hi-C matrix H between the positions N1 and N2, averaged over
+    blocks of bins if the window has more than npixels bins
+    """
+    n1 = N1//hic_res
+    n2 = N2//hic_res
+    M = downsample_matrix (H[n1:n2,n1:n2], npixels)
+    with np.errstate (divide='ignore') :
+        M = 1-np.log2(M)
+    ax.matshow (M,
              cmap=plt.cm.gray,
              origin='lower',
              extent=[N1+offset,N2+offset,N1+offset,N2+offset],
              interpolation='none')
 
-def line_plot (ax,xvals,yvals,N1=None,N2=None,show_xaxis=False) :
+def line_plot (ax,xvals,yvals,N1=None,N2=None,show_xaxis=False,npoints=max_pixels) :
     if N1 is not None and N2 is not None :
         ax.set_xlim (N1,N2)
         mask = np.logical_and(xvals>N1,xvals<N2)
@@ -71,8 +165,7 @@ def line_plot (ax,xvals,yvals,N1=None,N2=None,show_xaxis=False) :
         ax.set_xlim (min(xvals),max(xvals))
         mask = np.ones_like(xvals,dtype=bool)
     # plot values
-    for x,y in zip(xvals[mask],yvals[mask]) :
-        ax.add_artist(Line2D((x,x),(0,y),color='k',linewidth=1))
+    stems (ax, xvals[mask], yvals[mask], npoints)
     # plot borders
     ymin = min(yvals)
     ymax = max(yvals)
@@ -87,3 +180,22 @@ def line_plot (ax,xvals,yvals,N1=None,N2=None,show_xaxis=False) :
         ax.spines['bottom'].set_visible(False)
     else :
         ax.get_xaxis().tick_bottom()
+
+def _render (task) :
+    plot, kwargs = task
+    plot (show=False, **kwargs)
+    return kwargs ['fname']
+
+def render_figures (plot, tasks, nprocs=None) :
+    """
+    Renders figures to files in a pool of nprocs processes. plot is a
+    module-level function taking the arguments show and fname, such as
+    visualize_model_results, and tasks is a list of dicts of its other
+    arguments, each with its fname. Return the list of the files
+    """
+    pool = multiprocessing.Pool (nprocs)
+    try :
+        return list (pool.imap_unordered (_render, [(plot, kwargs) for kwargs in tasks]))
+    finally :
+        pool.close ()
+        pool.join ()
@@ -0,0 +1,38 @@
+"""
+Command line tool to warm the binary cache of the Hi-C matrices of all the
+chromosomes, before launching the worker processes that use them.
+"""
+import argparse
+from .read_data import load_hic, chromosome_names
+from .cache import clear_cache
+from .messages import log_message
+
+def warm_hic_cache (names=None, normalized=True, sparse=False, max_distance=None) :
+    """
+    Builds the cache of the Hi-C matrices of the chromosomes
+    """
+    if names is None :
+        names = chromosome_names
+    for name in names :
+        log_message ("warm_hic_cache", "Caching Hi-C matrix of chromosome %s" % name)
+        load_hic (name, normalized=normalized, sparse=sparse,
+                  max_distance=max_distance, cache=True)
+
+def main () :
+    parser = argparse.ArgumentParser (description="Warm the binary cache of the Hi-C matrices")
+    parser.add_argument ("chromosomes", nargs='*', help="chromosomes to cache (default: all)")
+    parser.add_argument ("--raw", action='store_true', help="cache the non-normalized matrices")
+    parser.add_argument ("--sparse", action='store_true', help="cache the sparse matrices")
+    parser.add_argument ("--max-distance", type=int, default=None,
+                         help="keep only the entries within this distance from the diagonal")
+    parser.add_argument ("--clear", action='store_true', help="clear the cache first")
+    args = parser.parse_args ()
+    if args.clear :
+        clear_cache ()
+    warm_hic_cache (args.chromosomes if args.chromosomes else None,
+                    normalized=not args.raw,
+                    sparse=args.sparse,
+                    max_distance=args.max_distance)
+
+if __name__ == '__main__' :
+    main ()